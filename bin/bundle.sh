@@ -1,14 +1,21 @@
 #!/bin/bash -ve
 cd course-data
 
+# the published bundles, with the caches and fingerprints kept next to them,
+# let bundle skip the terms that haven't changed and write deltas against
+# the last version (the clone only has master, so fetch gh-pages first)
+git fetch --quiet --depth=1 origin gh-pages && published=FETCH_HEAD || published=
+
 # prepare the gh-pages branch
 git checkout -B gh-pages master --no-track
+if [ -n "$published" ]; then git checkout "$published" -- terms/; fi
 
 # update bundled information for public consumption
-python3 ../read-enroll.py --dest ./ bundle
+python3 ../read-enroll.py --dest ./ bundle --delta-history 10
 
-# remove the source files (quietly)
+# remove the source files (quietly), and the uncommitted fetch caches with them
 git rm -rf --quiet indices/
+rm -rf indices/ .catalog.json
 
 # and … push
 git add --all ./
@@ -2,23 +2,16 @@
 cd course-data
 
 # update course data files
-# seq -w prints the leading zeros
-# tail -c3 gets us the last "3" chars of the year: 1,8,\n
-function terms() {
-    for y in 99 $(seq -w 00 $(date +%Y | tail -c3)); do
-        for s in WI SP FA; do
-            echo "$y$s"
-        done
-    done
-}
-
-# -n1 to only pass one argument from stdin to the process
-# -P2 to run 2 concurrent fetch processes
-terms | xargs -t -n1 -P2 -- python3 ../read-enroll.py --dest ./ fetch
+# one process keeps several requests in flight over a pooled connection,
+# while --rate caps how many requests per second Enroll actually sees
+python3 ../read-enroll.py --dest ./ fetch --first-term 99WI --workers 4 --rate 2
 
 # extract the data in more-parallel fashion than we dare fetch it
 python3 ../read-enroll.py --dest ./ extract --first-term 99FA
 
-git add .
+# the times each page was last checked, and the cached list of terms and
+# subjects, only matter to the next run here
+git add . ':(exclude)*.fetch-checked.json' ':(exclude).catalog.json'
+git rm --cached --quiet --ignore-unmatch .catalog.json
 git commit -m "course data update $(date)" || (echo "No updates found." && exit 0)
 git push "https://$GITHUB_OAUTH@github.com/carls-app/course-data.git" master
@@ -3,14 +3,19 @@
  Scrapes data from Carleton Enroll website containing course schedule information.
  """
 
-from bs4 import BeautifulSoup
+from lxml import etree
 from argparse import ArgumentParser
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlparse
 from collections import OrderedDict
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from multiprocessing import cpu_count
+import calendar
+import csv
 import itertools
-import requests
+import mmap
+import socket
+import threading
 import os
 import re
 import sys
@@ -18,24 +23,39 @@ import time
 import json
 from pathlib import Path
 import hashlib
+import heapq
 import datetime
+import gzip
+import random
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unicodedata
+import zlib
 
 
-def json_folder_map(folder, name='index', dry_run=False):
+def json_folder_map(folder, name='index', dry_run=False, workers=None, force=False, kept=()):
     output = {
         'files': [],
         'type': 'courses',
     }
 
-    for file in os.scandir(folder):
-        filename = file.name
-        if filename.startswith('.'):
-            continue
+    hashes = hash_folder(folder, dry_run=dry_run, workers=workers, force=force, kept=kept)
+
+    for filename in hashes:
+        # eg: 18FA.json is a bundle, and 18FA.columns.json is a "columns" artifact
+        basename, _, suffix = filename.partition('.')
+        extension = suffix.split('.')[0]
 
-        filepath = folder / filename
-        with open(filepath, 'rb') as infile:
-            basename, extension = os.path.splitext(filename)
-            extension = extension[1:]  # splitext's extension includes the preceding dot
+        info = {
+            'path': f'terms/{filename}',
+            'hash': hashes[filename],
+            'type': extension,
+        }
+
+        # the artifacts that span every term (like all.search.json) have no term
+        if TERM_RE.match(basename):
             year = basename[0:2]
             year = '19' + year if year == '99' else '20' + year
             year = int(year)
@@ -47,16 +67,13 @@ def json_folder_map(folder, name='index', dry_run=False):
             elif semester == 'SP':
                 semester = 3
 
-            info = {
-                'path': f'terms/{filename}',
-                'hash': hashlib.sha256(infile.read()).hexdigest(),
+            info.update({
                 'year': year,  # eg: 19943.json -> 1994
                 'term': int(str(year) + str(semester)),  # eg: 19943.json -> 19943
                 'semester': basename[2:4],
-                'type': extension,
-            }
+            })
 
-            output['files'].append(OrderedDict(sorted(info.items())))
+        output['files'].append(OrderedDict(sorted(info.items())))
 
     output['files'] = sorted(output['files'], key=lambda item: item['path'])
     output = OrderedDict(sorted(output.items()))
@@ -73,12 +90,113 @@ def json_folder_map(folder, name='index', dry_run=False):
     print('Wrote', index_path)
 
 
+def hash_folder(folder, dry_run=False, workers=None, force=False, kept=()):
+    """Returns the SHA-256 of every (non-hidden) file in `folder`. Hashes are
+    cached in `.hashes.json` by size and modification time, so only new or
+    changed files are read, and those are hashed in parallel. The files
+    named in `kept` are known not to have been rewritten, so their cached
+    hashes are trusted as long as their size matches (a checkout gives
+    every file a new mtime). `force` ignores the cache."""
+    cache_path = folder / '.hashes.json'
+    cache = {} if force else load_manifest(cache_path)
+
+    hashes = {}
+    stale = {}
+    for file in os.scandir(folder):
+        if file.name.startswith('.') or not file.is_file():
+            continue
+
+        stat = file.stat()
+        key = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        cached = cache.get(file.name)
+        checked = ['size'] if file.name in kept else key.keys()
+        if cached and all(cached.get(k) == key[k] for k in checked):
+            hashes[file.name] = cached['hash']
+            cached.update(key)
+        else:
+            stale[file.name] = key
+
+    # hashlib releases the GIL while it works, so threads are enough here
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        names = list(stale.keys())
+        for filename, digest in zip(names, executor.map(lambda n: hash_file(folder / n), names)):
+            hashes[filename] = digest
+            stale[filename]['hash'] = digest
+
+    if not dry_run:
+        save_manifest(cache_path, {name: stale.get(name) or cache[name] for name in hashes})
+
+    return hashes
+
+
 def expand_term(term):
     year, sem = term[:2], term[2:]
     year = int(f'20{year}') if year < '90' else int(f'19{year}')
     return year, sem
 
 
+def term_code(term):
+    # eg: 18FA -> 20181, so that codes sort chronologically
+    year, sem = expand_term(term)
+    return int(f'{year}{["FA", "WI", "SP"].index(sem) + 1}')
+
+
+def term_end_date(term):
+    # Roughly when each term's registration settles down for good
+    year, sem = expand_term(term)
+    month, day = {'FA': (12, 15), 'WI': (3, 31), 'SP': (6, 15)}[sem]
+    return datetime.date(year, month, day)
+
+
+def is_closed_term(term, *, closed_after, today=None):
+    today = today or datetime.date.today()
+    return (today - term_end_date(term)).days > closed_after
+
+
+def timestamp():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_timestamp(stamp):
+    return datetime.datetime.strptime(stamp, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def load_manifest(path):
+    try:
+        with open(path, 'r') as infile:
+            return json.load(infile)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(path, manifest):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_if_changed(path, json.dumps(manifest, indent='\t', sort_keys=True, ensure_ascii=False) + '\n')
+
+
+def write_if_changed(path, contents):
+    """Writes `contents` to `path` (see `write_atomically`), unless the file
+    already holds exactly that. Returns whether anything was written."""
+    try:
+        with open(path, 'r') as infile:
+            if infile.read() == contents:
+                return False
+    except FileNotFoundError:
+        pass
+
+    write_atomically(path, contents)
+
+    return True
+
+
+def write_atomically(path, contents):
+    # readers see either the old file or the new one, never half of one
+    tmp_path = path.with_name(f'.{path.name}.tmp')
+    with open(tmp_path, 'w') as outfile:
+        outfile.write(contents)
+    os.replace(tmp_path, path)
+
+
 def discover_terms(*, first, last):
     term_names = ['FA', 'WI', 'SP']
 
@@ -110,19 +228,562 @@ def discover_terms(*, first, last):
             yield f'{year}{t}'
 
 
-def fetch_academic_terms():
-    """Returns a list of academic terms that user can choose from."""
-    html_enroll = requests.get('https://apps.carleton.edu/campus/registrar/schedule/enroll/').text
-    soup = BeautifulSoup(html_enroll, 'lxml')
-    opts = soup.select_one("#termElement").find_all("option")
-    return [opt['value'] for opt in opts]
+_probe = threading.local()
+
+
+def add_stat(name, value):
+    """Adds `value` to the stats of the unit of work running on this thread,
+    if `instrumented` is running one."""
+    stats = getattr(_probe, 'stats', None)
+    if stats is not None:
+        stats[name] = stats.get(name, 0) + value
+
 
+@contextmanager
+def timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stat(name, time.perf_counter() - start)
+
+
+def instrumented(fn, profile=False, **kwargs):
+    """Runs `fn(**kwargs)`, and returns its result along with the stats that
+    it reported along the way. It is meant to wrap every unit of work that
+    a command hands to its workers, so that the stats come back with it."""
+    _probe.stats = {}
+
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # newer Pythons only allow one profiler at a time, so a thread
+            # that finds one running goes unprofiled
+            profiler = None
+
+    start = time.perf_counter()
+    try:
+        result = fn(**kwargs)
+    finally:
+        if profiler:
+            profiler.disable()
+        stats, _probe.stats = _probe.stats, None
+
+    stats['seconds'] = time.perf_counter() - start
+    if profiler:
+        profiler.create_stats()
+        stats['profile'] = profiler.stats
+
+    return result, stats
+
+
+class ProfileStats:
+    # just enough of a cProfile.Profile for pstats to load the stats of one
+    # that ran in another process
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class Metrics:
+    """Collects the stats of every unit of work in a run, to summarize them
+    per stage at the end. Unless it is `enabled`, nothing is kept, so that
+    a long `watch` doesn't pile up samples nobody will read."""
+
+    def __init__(self, *, command, workers, profile=None, enabled=True):
+        self.command = command
+        self.enabled = enabled
+        self.workers = workers
+        self.profile = profile
+        self.profile_stats = None
+        self.samples = OrderedDict()
+        self.started = timestamp()
+        self.start = time.perf_counter()
+
+    def record(self, stage, ident, stats):
+        """Records the `stats` of one unit of work, or a failure if they're None."""
+        if not self.enabled:
+            return
+
+        samples = self.samples.setdefault(stage, [])
+        if stats is None:
+            samples.append({'ident': ident, 'failed': True})
+            return
+
+        profile = stats.pop('profile', None)
+        if profile is not None:
+            import pstats
+            if self.profile_stats is None:
+                self.profile_stats = pstats.Stats(ProfileStats(profile))
+            else:
+                self.profile_stats.add(ProfileStats(profile))
 
-def fetch_subjects():
-    """Returns a list of course subjects."""
-    html_enroll = requests.get('https://apps.carleton.edu/campus/registrar/schedule/enroll/').text
+        samples.append(dict(stats, ident=ident))
+
+    def unwrap(self, stage, ident, future):
+        """Returns the result of an `instrumented` future, recording its stats."""
+        try:
+            result, stats = future.result()
+        except Exception:
+            self.record(stage, ident, None)
+            raise
+        self.record(stage, ident, stats)
+        return result
+
+    def take(self, stage, ident, outcome):
+        """Like `unwrap`, for one of the outcomes of a batch (see `run_batch`)."""
+        result, error = outcome
+        if error is not None:
+            self.record(stage, ident, None)
+            raise error
+        result, stats = result
+        self.record(stage, ident, stats)
+        return result
+
+    def summarize(self, samples):
+        done = [sample for sample in samples if not sample.get('failed')]
+        names = sorted({name for sample in done for name, value in sample.items()
+                        if isinstance(value, (int, float)) and not isinstance(value, bool)})
+
+        summary = OrderedDict()
+        for name in names:
+            values = sorted(sample[name] for sample in done if name in sample)
+            summary[name] = OrderedDict([
+                ('max', round(values[-1], 4)),
+                ('mean', round(sum(values) / len(values), 4)),
+                ('p50', round(values[len(values) // 2], 4)),
+                ('p95', round(values[min(len(values) - 1, int(len(values) * 0.95))], 4)),
+                ('total', round(sum(values), 4)),
+            ])
+
+        slowest = sorted(done, key=lambda sample: sample['seconds'], reverse=True)[:10]
+        return OrderedDict([
+            ('count', len(done)),
+            ('failed', [sample['ident'] for sample in samples if sample.get('failed')]),
+            ('metrics', summary),
+            ('slowest', [OrderedDict(sorted((k, round(v, 4) if isinstance(v, float) else v) for k, v in sample.items()))
+                         for sample in slowest]),
+        ])
+
+    def report(self):
+        seconds = time.perf_counter() - self.start
+        busy = sum(sample.get('seconds', 0) for samples in self.samples.values() for sample in samples)
+        return OrderedDict([
+            ('command', self.command),
+            ('seconds', round(seconds, 4)),
+            ('stages', OrderedDict((stage, self.summarize(samples)) for stage, samples in self.samples.items())),
+            ('started', self.started),
+            # the share of the run's worker-seconds that went to actual work
+            ('utilization', round(busy / (seconds * self.workers), 4) if seconds and self.workers else None),
+            ('workers', self.workers),
+        ])
+
+    def save(self, path):
+        with open(path, 'w') as outfile:
+            json.dump(self.report(), outfile, indent='\t', ensure_ascii=False)
+            outfile.write('\n')
+        print('Wrote', path)
+
+        if self.profile and self.profile_stats is not None:
+            self.profile_stats.dump_stats(self.profile)
+            print('Wrote', self.profile)
+
+
+def plan_batches(sizes, *, workers, per_worker=8):
+    """Orders work largest-first, so that the big items don't straggle at the
+    end of a run, and groups the small items into batches of roughly equal
+    size, so that they don't each pay for a round trip to a worker process.
+    Returns lists of indices into `sizes`."""
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+    target = sum(sizes) / (max(workers, 1) * per_worker)
+
+    batches = []
+    batch, batch_size = [], 0
+    for i in order:
+        batch.append(i)
+        batch_size += sizes[i]
+        if batch_size >= target:
+            batches.append(batch)
+            batch, batch_size = [], 0
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def run_batch(fn, batch, profile=False):
+    """Runs `instrumented(fn, **kwargs)` for every kwargs in `batch`, in a
+    worker. Returns a (result, exception) pair for each."""
+    outcomes = []
+    for kwargs in batch:
+        # noinspection PyBroadException
+        try:
+            outcomes.append((instrumented(fn, profile=profile, **kwargs), None))
+        except Exception as e:
+            outcomes.append((None, e))
+    return outcomes
+
+
+def submit_batches(executor, fn, jobs, *, workers, profile=False):
+    """Submits `jobs`, a list of (job, size, kwargs for `fn`), to `executor`
+    in batches (see `plan_batches`). Returns {future: [job, ...]}."""
+    futures = {}
+    for batch in plan_batches([size for _, size, _ in jobs], workers=workers):
+        key = executor.submit(run_batch, fn, [jobs[i][2] for i in batch], profile=profile)
+        futures[key] = [jobs[i][0] for i in batch]
+    return futures
+
+
+def iter_batches(futures):
+    """Yields (job, (result, exception)) for every job, as its batch finishes."""
+    for future in as_completed(futures):
+        jobs = futures[future]
+        # noinspection PyBroadException
+        try:
+            outcomes = future.result()
+        except Exception as e:
+            # the whole batch was lost, eg: because its worker died
+            outcomes = [(None, e)] * len(jobs)
+        yield from zip(jobs, outcomes)
+
+
+@contextmanager
+def process_pool(*, workers, executor=None):
+    """Uses `executor` if we were given one (see `cmd_build`), or a new pool."""
+    if executor is not None:
+        yield executor
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield executor
+
+
+ENROLL_URL = 'https://apps.carleton.edu/campus/registrar/schedule/enroll/'
+
+
+class RateLimiter:
+    """A thread-safe token bucket: hands out `rate` tokens per second, and
+    lets up to `burst` of them accumulate while nobody is asking."""
+
+    def __init__(self, *, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class Pack:
+    """An append-only file of individually compressed records, plus an index
+    (`<file>.index`, one JSON line per record) of where each one starts, so
+    that any record can be read without decompressing the others. Writing a
+    key again appends a new record, which then shadows the old one."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index_path = self.path.with_name(self.path.name + '.index')
+        self.lock = threading.Lock()
+        self.index = {}
+
+        if self.index_path.exists():
+            with open(self.index_path, 'r') as infile:
+                for line in infile:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry.get('deleted'):
+                        self.index.pop(entry['key'], None)
+                    else:
+                        self.index[entry['key']] = entry
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(sorted(self.index))
+
+    def meta(self, key):
+        return self.index[key]
+
+    def read(self, key):
+        entry = self.index[key]
+        with open(self.path, 'rb') as infile:
+            infile.seek(entry['offset'])
+            return zlib.decompress(infile.read(entry['length']))
+
+    def write(self, key, data, **meta):
+        compressed = zlib.compress(data, 9)
+
+        with self.lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'ab') as outfile:
+                offset = outfile.tell()
+                outfile.write(compressed)
+
+            entry = dict(meta, key=key, offset=offset, length=len(compressed))
+            with open(self.index_path, 'a') as outfile:
+                outfile.write(json.dumps(entry, sort_keys=True, ensure_ascii=False) + '\n')
+
+            self.index[key] = entry
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.index:
+                return
+            with open(self.index_path, 'a') as outfile:
+                outfile.write(json.dumps({'deleted': True, 'key': key}) + '\n')
+            del self.index[key]
+
+    def is_bloated(self):
+        """Whether more than half of the file is taken up by shadowed or deleted records."""
+        if not self.path.exists():
+            return False
+        live = sum(entry['length'] for entry in self.index.values())
+        return self.path.stat().st_size > 2 * live
+
+    def compact(self):
+        """Rewrites the pack with only its live records, in key order."""
+        with self.lock:
+            tmp_path = self.path.with_name(f'.{self.path.name}.tmp')
+            tmp_index_path = self.index_path.with_name(f'.{self.index_path.name}.tmp')
+
+            index = {}
+            with open(self.path, 'rb') as infile, open(tmp_path, 'wb') as outfile:
+                for key in sorted(self.index):
+                    entry = self.index[key]
+                    infile.seek(entry['offset'])
+                    data = infile.read(entry['length'])
+                    index[key] = dict(entry, offset=outfile.tell())
+                    outfile.write(data)
+
+            with open(tmp_index_path, 'w') as outfile:
+                for key in sorted(index):
+                    outfile.write(json.dumps(index[key], sort_keys=True, ensure_ascii=False) + '\n')
+
+            os.replace(tmp_path, self.path)
+            os.replace(tmp_index_path, self.index_path)
+            self.index = index
+
+    def unlink(self):
+        """Removes the pack and its index from disk."""
+        with self.lock:
+            for path in (self.path, self.index_path):
+                if path.exists():
+                    path.unlink()
+            self.index = {}
+
+
+def archive_key(params):
+    # archives are keyed by query string alone, so that one recorded from the
+    # real Enroll can be served from anywhere
+    return urlencode(sorted(params.items()))
+
+
+class EnrollClient:
+    """Talks to Enroll over one pooled, keep-alive session, with every request
+    going through a shared rate limiter so that any number of threads can use
+    it while staying polite. Transient failures (dropped connections,
+    timeouts, 5xx and 429 responses) are retried up to `retries` times. It
+    can also record every response to a `Pack`, or answer requests from one
+    instead of the network."""
+
+    def __init__(self, *, base_url=ENROLL_URL, rate=None, burst=1, max_connections=1, timeout=60,
+                 retries=0, backoff=1.0, record=None, replay=None):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate=rate, burst=burst)
+        self.record = record
+        self.replay = replay
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(max_connections, 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, *, headers=None, **params):
+        if self.replay is not None:
+            return self.replayed(params)
+
+        import requests
+
+        for attempt in itertools.count():
+            try:
+                return self.request(params, headers)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.HTTPError) as e:
+                status = e.response.status_code if e.response is not None else None
+                if attempt >= self.retries or (status is not None and status < 500 and status != 429):
+                    raise
+
+                # exponential backoff with full jitter, so that the requests
+                # that failed together don't all come back together
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                add_stat('retries', 1)
+                print(f'retrying {archive_key(params) or "the landing page"} in {delay:.1f}s: {e}', file=sys.stderr)
+                time.sleep(delay)
+
+    def request(self, params, headers):
+        with timed('throttle_seconds'):
+            self.limiter.acquire()
+        with timed('http_seconds'):
+            response = self.session.get(self.base_url, params=params, headers=headers, timeout=self.timeout)
+        add_stat('requests', 1)
+        add_stat('http_bytes', len(response.content))
+        response.raise_for_status()
+
+        if self.record is not None and response.status_code == 200:
+            kept = {k: v for k, v in response.headers.items() if k.lower() in ARCHIVED_HEADERS}
+            self.record.write(archive_key(params), response.content,
+                              status=response.status_code, headers=kept, encoding=response.encoding)
+
+        return response
+
+    def replayed(self, params):
+        import requests
+        from requests.structures import CaseInsensitiveDict
+
+        key = archive_key(params)
+        if key not in self.replay:
+            raise LookupError(f'{key or "the landing page"} is not in {self.replay.path}')
+
+        entry = self.replay.meta(key)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = entry['encoding']
+        response.url = f'{self.base_url}?{key}'
+        response._content = self.replay.read(key)
+        return response
+
+
+ARCHIVED_HEADERS = ['content-type', 'etag', 'last-modified']
+
+
+def make_client(args):
+    """Returns the EnrollClient for this run, creating it on first use, so that
+    every request in a run shares one session and one rate limit."""
+    if getattr(args, 'client', None) is None:
+        rate = args.rate if args.rate is not None else (1 / args.delay if args.delay else None)
+        args.client = EnrollClient(base_url=args.enroll_url,
+                                   rate=rate,
+                                   burst=args.burst,
+                                   max_connections=args.workers or 1,
+                                   retries=args.retries,
+                                   backoff=args.backoff,
+                                   record=Pack(args.record) if args.record else None,
+                                   replay=Pack(args.replay) if args.replay else None)
+    return args.client
+
+
+def make_archive_handler(*, archive, latency, error_rate):
+    """Builds a request handler that plays Enroll, answering from `archive`,
+    after `latency` seconds (give or take half), and failing a fraction
+    `error_rate` of requests with either a 503 or a dropped connection."""
+
+    from http.server import BaseHTTPRequestHandler
+    from requests.structures import CaseInsensitiveDict
+
+    class ArchiveHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if latency:
+                time.sleep(latency * random.uniform(0.5, 1.5))
+
+            if random.random() < error_rate:
+                if random.random() < 0.5:
+                    self.send_error(503, 'Injected failure')
+                else:
+                    self.close_connection = True
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                return
+
+            key = archive_key(dict(parse_qsl(urlparse(self.path).query)))
+            if key not in archive:
+                self.send_error(404, f'{key} is not in the archive')
+                return
+
+            entry = archive.meta(key)
+            headers = CaseInsensitiveDict(entry['headers'])
+            if headers.get('ETag') and self.headers.get('If-None-Match') == headers['ETag']:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            body = archive.read(key)
+            self.send_response(entry['status'])
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ArchiveHandler
+
+
+def cmd_serve(*, args):
+    from http.server import HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    if not args.replay:
+        sys.exit('serve needs an archive to serve; pass --replay FILE')
+
+    archive = Pack(args.replay)
+    handler = make_archive_handler(archive=archive, latency=args.latency, error_rate=args.error_rate)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), handler)
+
+    print(f'serving {len(archive.index)} responses from {archive.path} on http://127.0.0.1:{args.port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def fetch_catalog(*, client):
+    """Returns the subjects and academic terms that Enroll knows about, from
+    a single download of its landing page."""
+    from bs4 import BeautifulSoup
+
+    html_enroll = client.get().text
     soup = BeautifulSoup(html_enroll, 'lxml')
 
+    opts = soup.select_one("#termElement").find_all("option")
+    terms = [opt['value'] for opt in opts]
+
     subject_summary = soup.select_one("#subjectElement")
 
     # Create a list with subjects, excluding 'Selected' tag (first item)
@@ -130,8 +791,71 @@ def fetch_subjects():
 
     # Each item is currently in the form: 'Computer Science (CS)'. We only
     # want the abbreviation in the parentheses.
-    abbr = re.compile(r'\((.*?)\)')
-    return [abbr.search(item.get_text()).group(1) for item in subjects]
+    subjects = [SUBJECT_ABBR_RE.search(item.get_text()).group(1) for item in subjects]
+
+    return {'fetched': timestamp(), 'subjects': subjects, 'terms': terms}
+
+
+def load_catalog(*, args, root):
+    """Returns the catalog of subjects and terms, from the copy cached in
+    `.catalog.json` if it is younger than --catalog-ttl hours."""
+    path = root / '.catalog.json'
+    catalog = load_manifest(path)
+
+    if catalog and not args.force:
+        age = datetime.datetime.utcnow() - parse_timestamp(catalog['fetched'])
+        if age < datetime.timedelta(hours=args.catalog_ttl):
+            return catalog
+
+    catalog = fetch_catalog(client=make_client(args))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    save_manifest(path, catalog)
+    return catalog
+
+
+TERM_RE = re.compile(r'^\d\d(FA|WI|SP)$')
+
+
+def terms_on_disk(root):
+    found = set(IndexStore(root).terms()) | {d.name for d in (root / 'courses').glob('*') if d.is_dir()}
+    return sorted([t for t in found if TERM_RE.match(t)], key=expand_term)
+
+
+# Bump this whenever a change to the extraction code would change its output,
+# so that `extract` knows to redo subjects whose HTML hasn't changed.
+PARSER_VERSION = 3
+
+SUBJECT_ABBR_RE = re.compile(r'\((.*?)\)')
+SIZE_RE = re.compile(r'Size: (\d+)')
+REGISTERED_RE = re.compile(r'Registered: (\d+)')
+WAITLIST_RE = re.compile(r'Waitlist: (\d+)')
+CREDITS_RE = re.compile(r'([\d.])+')
+SYNONYM_RE = re.compile(r'Synonym: (\d+)')
+
+
+def clock_minutes(text):
+    # eg: "10:10 AM" -> 610
+    try:
+        clock = datetime.datetime.strptime(text.strip(), '%I:%M %p')
+    except (AttributeError, ValueError):
+        return None
+    return clock.hour * 60 + clock.minute
+
+
+WEEK_DAYS = ['Su', 'Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa']
+
+
+def meeting_intervals(times):
+    """Returns each meeting in `times` as [start, end] minutes since Sunday
+    at midnight, in order. eg: Mo 10:10 AM-11:20 AM -> [2050, 2120]"""
+    intervals = []
+    for meeting in times:
+        start, end = clock_minutes(meeting['start']), clock_minutes(meeting['end'])
+        if meeting['day'] not in WEEK_DAYS or start is None or end is None or end <= start:
+            continue
+        day = WEEK_DAYS.index(meeting['day']) * 24 * 60
+        intervals.append([day + start, day + end])
+    return sorted(intervals)
 
 
 def process_course(course, term):
@@ -183,8 +907,9 @@ def process_course(course, term):
     else:
         prereq = None
 
-    # and the comments
-    comments = [el.get_text().strip() for el in course.select('.comments')]
+    # and the comments (whose whitespace depends on how the page was stored,
+    # since prettifying breaks lines around inline markup)
+    comments = [' '.join(el.get_text().split()) for el in course.select('.comments')]
 
     # Extract the course status
     status = course.select_one('.statusName').get_text().strip().strip(':')
@@ -193,9 +918,9 @@ def process_course(course, term):
 
     if course.select_one(".statusName").next_sibling:
         status_text = str(course.select_one(".statusName").next_sibling).strip()
-        total_size = int(re.search(r'Size: (\d+)', status_text).group(1))
-        registered = int(re.search(r'Registered: (\d+)', status_text).group(1))
-        waitlist = int(re.search(r'Waitlist: (\d+)', status_text).group(1))
+        total_size = int(SIZE_RE.search(status_text).group(1))
+        registered = int(REGISTERED_RE.search(status_text).group(1))
+        waitlist = int(WAITLIST_RE.search(status_text).group(1))
         size = {'total': total_size, 'registered': registered, 'waitlist': waitlist}
     else:
         size = None
@@ -221,7 +946,7 @@ def process_course(course, term):
 
     if course.select_one('.credits'):
         credits_el = course.select_one('.credits')
-        credit_count = float(re.search(r'([\d.])+', credits_el.get_text()).group(1))
+        credit_count = float(CREDITS_RE.search(credits_el.get_text()).group(1))
 
         if credits_el.select_one('abbr'):
             scnc = credits_el.select_one('abbr').get_text().strip()
@@ -235,7 +960,7 @@ def process_course(course, term):
 
     if course.select_one('.textbooks'):
         el = course.select_one('.textbooks')
-        synonym = re.search(r'Synonym: (\d+)', el.get_text()).group(1)
+        synonym = SYNONYM_RE.search(el.get_text()).group(1)
     else:
         synonym = None
 
@@ -274,7 +999,7 @@ def process_course(course, term):
                     'end': end.get_text().strip(),
                 })
 
-        offerings = {'times': times, 'locations': locations}
+        offerings = {'times': times, 'intervals': meeting_intervals(times), 'locations': locations}
     else:
         offerings = None
 
@@ -302,7 +1027,242 @@ def process_course(course, term):
     }
 
 
-def clean_html(html):
+def _has_class(name):
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# The lxml engine's equivalents of the CSS selectors used by `process_course`,
+# compiled once instead of once per course
+XP_COURSES = etree.XPath(f'(//*[@id="enrollModule"]//*[{_has_class("courses")}])[1]')
+XP_COURSE = etree.XPath(f'.//*[{_has_class("course")}]')
+XP_COURSENUM = etree.XPath(f'(.//*[{_has_class("coursenum")}])[1]')
+XP_TITLE_COURSENUM = etree.XPath(f'(.//*[{_has_class("title")}]//*[{_has_class("coursenum")}])[1]')
+XP_FACULTY = etree.XPath(f'(.//*[{_has_class("faculty")}])[1]')
+XP_FACULTY_LINKS = etree.XPath(f'.//*[{_has_class("faculty")}]//a')
+XP_PREREQ = etree.XPath(f'(.//*[{_has_class("prereq")}])[1]')
+XP_DESCRIPTION = etree.XPath(f'(.//*[{_has_class("description")}])[1]')
+XP_COMMENTS = etree.XPath(f'.//*[{_has_class("comments")}]')
+XP_STATUS_NAME = etree.XPath(f'(.//*[{_has_class("statusName")}])[1]')
+XP_GOV_CODES = etree.XPath(f'.//*[{_has_class("codes")} and {_has_class("gov_codes")}]')
+XP_GOV_CODE_LINKS = etree.XPath(f'.//*[{_has_class("codes")} and {_has_class("gov_codes")}]//a')
+XP_OVERLAYS = etree.XPath(f'.//*[{_has_class("codes")} and {_has_class("overlays")}]')
+XP_OVERLAY_LINKS = etree.XPath(f'.//*[{_has_class("codes")} and {_has_class("overlays")}]//a')
+XP_CREDITS = etree.XPath(f'(.//*[{_has_class("credits")}])[1]')
+XP_ABBR = etree.XPath('(.//abbr)[1]')
+XP_TEXTBOOKS = etree.XPath(f'(.//*[{_has_class("textbooks")}])[1]')
+XP_HAS_SCHEDULE = etree.XPath(f'boolean(.//*[{_has_class("schedule")}]//*)')
+XP_SCHEDULE = etree.XPath(f'(.//*[{_has_class("schedule")}])[1]')
+XP_LOCATION_LINKS = etree.XPath(f'.//*[{_has_class("locations")}]//a')
+XP_ROWS = etree.XPath('.//tr')
+XP_HEADERS = etree.XPath('.//th')
+XP_CELLS = etree.XPath('.//td')
+XP_START = etree.XPath(f'.//*[{_has_class("start")}]')
+XP_END = etree.XPath(f'.//*[{_has_class("end")}]')
+XP_TEXT = etree.XPath('string()')
+
+
+def _first(xpath, el):
+    found = xpath(el)
+    return found[0] if found else None
+
+
+def _text(el):
+    return str(XP_TEXT(el))
+
+
+def _sibling_node(node):
+    # BeautifulSoup hands back the text of a comment, and the markup of a tag
+    if node.tag is etree.Comment:
+        return node.text or ''
+    return etree.tostring(node, encoding='unicode', method='html', with_tail=False)
+
+
+def _next_sibling(el):
+    """Mirrors BeautifulSoup's `el.next_sibling`, where lxml keeps the text
+    that follows an element in its `tail`."""
+    if el.tail:
+        return el.tail
+    node = el.getnext()
+    return _sibling_node(node) if node is not None else None
+
+
+def _previous_sibling(el):
+    """Mirrors BeautifulSoup's `el.previous_sibling`."""
+    node = el.getprevious()
+    text = node.tail if node is not None else el.getparent().text
+    if text:
+        return text
+    return _sibling_node(node) if node is not None else None
+
+
+def process_course_lxml(course, term):
+    """The same as `process_course`, but for an lxml element. Each selector is
+    run once per course, and only if its answer is needed."""
+    year, semester = expand_term(term)
+
+    # Split apart the deptnum
+    subject, number = _text(XP_COURSENUM(course)[0]).strip().split(' ')
+    number, section = number.split('.')
+
+    course_type = 'Course'
+    if number[-1] == 'L':
+        course_type = 'Lab'
+    elif number[-1] == 'J':
+        course_type = 'Juried'
+    elif number[-1] == 'F':
+        course_type = 'FLAC'
+    elif number[-1] == 'S':
+        course_type = 'St. Olaf'
+
+    title = _next_sibling(XP_TITLE_COURSENUM(course)[0]).strip()
+
+    faculty = _first(XP_FACULTY, course)
+    if faculty is not None:
+        instructors = [' '.join(_text(inst).strip().split()) for inst in XP_FACULTY_LINKS(course)]
+        instructors = [name for name in instructors if name]
+    else:
+        instructors = []
+
+    prereq_el = _first(XP_PREREQ, course)
+    faculty_sibling = _next_sibling(faculty) if faculty is not None else None
+    prereq_sibling = _previous_sibling(prereq_el) if prereq_el is not None and not faculty_sibling else None
+
+    if faculty_sibling:
+        summary = faculty_sibling.strip()
+    elif prereq_sibling:
+        summary = prereq_sibling.strip()
+    else:
+        description = _first(XP_DESCRIPTION, course)
+        summary = _text(description).strip() if description is not None else None
+    if not summary:
+        summary = None
+
+    if prereq_el is not None:
+        prereq = ' '.join(_text(prereq_el).split()).strip() or None
+    else:
+        prereq = None
+
+    comments = [' '.join(_text(el).split()) for el in XP_COMMENTS(course)]
+
+    status_el = XP_STATUS_NAME(course)[0]
+    status = _text(status_el).strip().strip(':')
+    if not status:
+        status = None
+
+    status_text = _next_sibling(status_el)
+    if status_text:
+        status_text = status_text.strip()
+        total_size = int(SIZE_RE.search(status_text).group(1))
+        registered = int(REGISTERED_RE.search(status_text).group(1))
+        waitlist = int(WAITLIST_RE.search(status_text).group(1))
+        size = {'total': total_size, 'registered': registered, 'waitlist': waitlist}
+    else:
+        size = None
+
+    if XP_GOV_CODES(course):
+        tags = [{
+            'name': _text(code).strip(),
+            'code': parse_qs(code.get('href')).get('other_code[]', []),
+        } for code in XP_GOV_CODE_LINKS(course)]
+        tags = [tag['code'][0] if len(tag['code']) else tag['name'] for tag in tags]
+    else:
+        tags = []
+
+    if XP_OVERLAYS(course):
+        requirements = []
+        for code in XP_OVERLAY_LINKS(course):
+            query = parse_qs(code.get('href'))
+            codes = query.get('requirements[]', []) or query.get('overlays[]', [])
+            requirements.append(codes[0] if len(codes) else _text(code).strip())
+    else:
+        requirements = []
+
+    credits_el = _first(XP_CREDITS, course)
+    if credits_el is not None:
+        credit_count = float(CREDITS_RE.search(_text(credits_el)).group(1))
+
+        abbr = _first(XP_ABBR, credits_el)
+        if abbr is not None:
+            scnc = _text(abbr).strip()
+            assert scnc == 'S/CR/NC'
+            scnc = True if scnc == 'S/CR/NC' else None
+        else:
+            scnc = None
+    else:
+        credit_count = None
+        scnc = None
+
+    textbooks = _first(XP_TEXTBOOKS, course)
+    if textbooks is not None:
+        synonym = SYNONYM_RE.search(_text(textbooks)).group(1)
+    else:
+        synonym = None
+
+    if XP_HAS_SCHEDULE(course):
+        schedule = XP_SCHEDULE(course)[0]
+        locations = [_text(a).strip() for a in XP_LOCATION_LINKS(course)]
+
+        rows = XP_ROWS(schedule)
+
+        # there is at least one course that occurs on Saturday
+        days = ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa']
+        if len(XP_HEADERS(rows[0])) == 7:
+            days = ['Su', 'Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa']
+
+        times = []
+        for tr in rows[1:]:
+            for i, td in enumerate(XP_CELLS(tr)):
+                starts = XP_START(td)
+                ends = XP_END(td)
+                if len(starts) > 1 or len(ends) > 1:
+                    raise Exception('multiple times on the same day!')
+
+                if bool(starts) != bool(ends):
+                    raise Exception('unmatched start/end times!')
+
+                if not starts:
+                    continue
+
+                times.append({
+                    'day': days[i],
+                    'start': _text(starts[0]).strip(),
+                    'end': _text(ends[0]).strip(),
+                })
+
+        offerings = {'times': times, 'intervals': meeting_intervals(times), 'locations': locations}
+    else:
+        offerings = None
+
+    return {
+        'id': f'{year}{semester} {subject} {number}.{section}',
+        'comments': comments,
+        'credits': credit_count,
+        'instructors': instructors,
+        'number': number,
+        'offerings': offerings,
+        'prerequisites': prereq,
+        'requirements': requirements,
+        'scnc': scnc,
+        'section': section,
+        'semester': semester,
+        'size': size,
+        'status': status,
+        'subject': subject,
+        'summary': summary,
+        'synonym': synonym,
+        'tags': tags,
+        'title': title,
+        'type': course_type,
+        'year': year,
+    }
+
+
+def clean_html(html, compact=False):
+    if compact:
+        return serialize_compact(clean_tree(etree.fromstring(html, etree.HTMLParser())))
+
+    from bs4 import BeautifulSoup
+
     # Clean up the returned HTML to optimize storage size
     soup = BeautifulSoup(html, 'lxml')
 
@@ -325,19 +1285,83 @@ def clean_html(html):
     return soup.prettify().strip()
 
 
-def fetch_subject_for_term(*, term, subject):
-    html_string = f'https://apps.carleton.edu/campus/registrar/schedule/enroll/?term={term}&subject={subject}'
+XP_ENROLL_MODULE = etree.XPath('(//*[@id="enrollModule"])[1]')
+XP_CLUTTER = [
+    etree.XPath('(.//*[@id="myCourses"])[1]'),
+    etree.XPath('(.//*[@id="disco_form"])[1]'),
+    etree.XPath(f'(.//*[{_has_class("searchDescription")}])[1]'),
+]
+
+
+def _drop(el):
+    # unlike BeautifulSoup's decompose(), removing an lxml element also
+    # removes the text after it, so hand that text to the previous node first
+    parent = el.getparent()
+    if el.tail:
+        previous = el.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + el.tail
+        else:
+            parent.text = (parent.text or '') + el.tail
+    parent.remove(el)
+
+
+def clean_tree(root):
+    """The lxml equivalent of `clean_html`: strips the page down to the
+    #enrollModule element, in place, and returns that element."""
+    module = _first(XP_ENROLL_MODULE, root)
+
+    for xpath in XP_CLUTTER:
+        el = _first(xpath, module)
+        if el is not None:
+            _drop(el)
+
+    return module
+
 
+def serialize_compact(el):
+    return etree.tostring(el, encoding='unicode', method='html', with_tail=False).strip()
+
+
+def fetch_subject_for_term(*, client, term, subject, headers=None, compact=False):
     # Course listings for subject during term provided
-    html = requests.get(html_string).text
+    response = client.get(term=term, subject=subject, headers=headers)
+
+    # the page hasn't changed since the validators in `headers` were issued
+    if response.status_code == 304:
+        return None, response
+
+    with timed('clean_seconds'):
+        html = clean_html(response.text, compact=compact)
+    return html, response
+
 
-    return clean_html(html)
+ENGINES = ['bs4', 'lxml']
 
 
-def extract_courses(*, html, term):
+def count_courses(root):
+    exact_courses_list = _first(XP_COURSES, root) if root is not None else None
+    return len(XP_COURSE(exact_courses_list)) if exact_courses_list is not None else 0
+
+
+def extract_courses_from_tree(*, root, term):
+    exact_courses_list = _first(XP_COURSES, root) if root is not None else None
+    courses = XP_COURSE(exact_courses_list) if exact_courses_list is not None else []
+    for course in courses:
+        yield process_course_lxml(course, term)
+
+
+def extract_courses(*, html, term, engine='bs4'):
     """ Returns dict object with course number, course name, and start/end times for each course
     Finds course info based on the academic term and subject chosen (in this case, Winter 2018)
     """
+    if engine == 'lxml':
+        root = etree.fromstring(html, etree.HTMLParser()) if html.strip() else None
+        yield from extract_courses_from_tree(root=root, term=term)
+        return
+
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html, 'lxml')
 
     # Creates list of all items with course as class attribute, excluding related courses
@@ -347,203 +1371,1849 @@ def extract_courses(*, html, term):
         yield process_course(course, term)
 
 
-def fetch_and_save(*, term, subject, root, delay):
-    folder = root / 'indices' / term / subject
-    folder.mkdir(parents=True, exist_ok=True)
+def check_parity(*, store, term: str, subject: str):
+    """Runs every extraction engine over a page, and returns a list of the
+    ways in which their output differs from the BeautifulSoup engine's."""
+    html = store.read(term, subject)
 
-    html = fetch_subject_for_term(term=term, subject=subject)
-    with open(folder / '_index.html', 'w') as outfile:
-        outfile.write(html)
-        outfile.write('\n')
+    results = {}
+    for engine in ENGINES:
+        # noinspection PyBroadException
+        try:
+            results[engine] = list(extract_courses(html=html, term=term, engine=engine))
+        except Exception as e:
+            results[engine] = e
+
+    expected = results['bs4']
+    differences = []
+    for engine in ENGINES[1:]:
+        actual = results[engine]
+
+        if isinstance(expected, Exception) or isinstance(actual, Exception):
+            if isinstance(expected, Exception) != isinstance(actual, Exception):
+                differences.append(f'{engine}: bs4 gave {expected!r}, {engine} gave {actual!r}')
+            continue
+
+        if len(expected) != len(actual):
+            differences.append(f'{engine}: bs4 found {len(expected)} courses, {engine} found {len(actual)}')
+
+        for left, right in zip(expected, actual):
+            for key in sorted(set(left) | set(right)):
+                if left.get(key) != right.get(key):
+                    differences.append(f'{engine}: {left["id"]}: {key}: {left.get(key)!r} != {right.get(key)!r}')
+
+    return differences
+
+
+STORAGE_KINDS = ['html', 'gzip', 'pack']
+
+
+class IndexStore:
+    """The cleaned Enroll pages under `indices/`. Each page is stored one of
+    three ways:
+
+    - html: as indices/<term>/<subject>/_index.html
+    - gzip: as indices/<term>/<subject>/_index.html.gz
+    - pack: as a record in indices/<term>.pack (see `Pack`)
+
+    Pages are read from wherever they are. They are written as `kind`, which
+    also removes any copy stored another way; without a `kind`, pages stay
+    where they are, and new ones are written as plain html."""
+
+    def __init__(self, root, kind=None):
+        self.root = root
+        self.folder = root / 'indices'
+        self.kind = kind
+        self.packs = {}
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        # packs hold locks, so worker processes get a fresh store of their own
+        return IndexStore, (self.root, self.kind)
+
+    def pack(self, term, create=False):
+        with self.lock:
+            if term not in self.packs:
+                path = self.folder / f'{term}.pack'
+                if not create and not path.exists():
+                    return None
+                self.packs[term] = Pack(path)
+            return self.packs[term]
+
+    def html_path(self, term, subject):
+        return self.folder / term / subject / '_index.html'
+
+    def gzip_path(self, term, subject):
+        return self.folder / term / subject / '_index.html.gz'
+
+    def stored_as(self, term, subject):
+        if self.html_path(term, subject).exists():
+            return 'html'
+        if self.gzip_path(term, subject).exists():
+            return 'gzip'
+        pack = self.pack(term)
+        if pack is not None and subject in pack:
+            return 'pack'
+        return None
+
+    def exists(self, term, subject):
+        return self.stored_as(term, subject) is not None
+
+    def pages(self, terms=None):
+        """Returns every stored (term, subject), optionally only for `terms`."""
+        found = set()
+        for subject_dir in self.folder.glob('*/*'):
+            if subject_dir.is_dir():
+                found.add((subject_dir.parent.name, subject_dir.name))
+        for pack_path in self.folder.glob('*.pack'):
+            term = pack_path.name[:-len('.pack')]
+            found.update((term, subject) for subject in self.pack(term))
+        return sorted([(term, subject) for term, subject in found if terms is None or term in terms])
+
+    def terms(self):
+        return sorted({term for term, _ in self.pages()})
+
+    def read(self, term, subject):
+        kind = self.stored_as(term, subject)
+        if kind == 'html':
+            with open(self.html_path(term, subject), 'r') as infile:
+                return infile.read()
+        if kind == 'gzip':
+            with gzip.open(self.gzip_path(term, subject), 'rt', encoding='utf-8') as infile:
+                return infile.read()
+        if kind == 'pack':
+            return self.pack(term).read(subject).decode('utf-8')
+        raise FileNotFoundError(f'no page stored for {term}/{subject}')
+
+    def size(self, term, subject):
+        """How many bytes a page takes up, as stored (so compressed pages look
+        smaller than they are), or None."""
+        kind = self.stored_as(term, subject)
+        if kind == 'html':
+            return self.html_path(term, subject).stat().st_size
+        if kind == 'gzip':
+            return self.gzip_path(term, subject).stat().st_size
+        if kind == 'pack':
+            return self.pack(term).meta(subject)['length']
+        return None
+
+    def digest(self, term, subject):
+        """The SHA-256 of a page's text, however it is stored, or None."""
+        kind = self.stored_as(term, subject)
+        if kind == 'html':
+            return hash_file(self.html_path(term, subject))
+        if kind == 'pack':
+            return self.pack(term).meta(subject)['hash']
+        if kind == 'gzip':
+            return hashlib.sha256(self.read(term, subject).encode('utf-8')).hexdigest()
+        return None
+
+    def write(self, term, subject, contents):
+        """Stores a page, unless an identical copy is already stored the same
+        way. Returns whether anything was written."""
+        current = self.stored_as(term, subject)
+        kind = self.kind or current or 'html'
+
+        if kind == current and self.read(term, subject) == contents:
+            return False
+
+        data = contents.encode('utf-8')
+        if kind == 'html':
+            self.html_path(term, subject).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.html_path(term, subject), 'w') as outfile:
+                outfile.write(contents)
+        elif kind == 'gzip':
+            self.gzip_path(term, subject).parent.mkdir(parents=True, exist_ok=True)
+            # a fixed mtime keeps the compressed bytes stable for git
+            with open(self.gzip_path(term, subject), 'wb') as raw, \
+                    gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=9, mtime=0) as outfile:
+                outfile.write(data)
+        elif kind == 'pack':
+            self.pack(term, create=True).write(subject, data, hash=hashlib.sha256(data).hexdigest())
+
+        if current and current != kind:
+            self.remove(term, subject, kind=current)
+
+        return True
+
+    def remove(self, term, subject, *, kind):
+        if kind == 'pack':
+            self.pack(term).delete(subject)
+            return
+
+        path = self.html_path(term, subject) if kind == 'html' else self.gzip_path(term, subject)
+        path.unlink()
+        if not any(path.parent.iterdir()):
+            path.parent.rmdir()
+
+    def close(self):
+        for term, pack in list(self.packs.items()):
+            if not pack.index:
+                # every page has moved out of it (or was never written)
+                pack.unlink()
+                del self.packs[term]
+            elif pack.is_bloated():
+                pack.compact()
+
+
+# when (seconds since the epoch), course, total, registered, waitlist, status
+SAMPLE = struct.Struct('<IIhhhB')
+
+
+def seat_samples(courses):
+    """Returns the (course id, total, registered, waitlist, status) of each course."""
+    samples = []
+    for course in courses:
+        size = course.get('size') or {}
+        samples.append((course['id'], size.get('total'), size.get('registered'), size.get('waitlist'),
+                        course.get('status')))
+    return samples
+
+
+class History:
+    """Seat counts over time, one append-only file per term under history/.
+
+    `<term>.series` is a run of fixed-width samples (see `SAMPLE`), so it
+    can be memory-mapped and read without any parsing. Courses and statuses
+    are stored as indices into the tables in `<term>.json`, and missing
+    counts as -1. A course only gets a new sample when its counts or status
+    change."""
+
+    def __init__(self, root):
+        self.folder = root / 'history'
+        self.tables = {}
+
+    def series_path(self, term):
+        return self.folder / f'{term}.series'
+
+    def table(self, term):
+        if term not in self.tables:
+            table = load_manifest(self.folder / f'{term}.json') or {'courses': [], 'statuses': []}
+            table['course_ids'] = {course_id: i for i, course_id in enumerate(table['courses'])}
+            table['last'] = {}
+            for _, course, *values in self.samples(term):
+                table['last'][course] = values
+            self.tables[term] = table
+        return self.tables[term]
+
+    def samples(self, term):
+        """Returns every raw sample of `term`, oldest first."""
+        path = self.series_path(term)
+        if not path.exists() or not path.stat().st_size:
+            return []
+        with open(path, 'rb') as infile, mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # a sample cut short by a crash is ignored
+            end = len(data) - len(data) % SAMPLE.size
+            return list(SAMPLE.iter_unpack(data[:end]))
+
+    def append(self, term, samples, *, when):
+        """Records `samples` (see `seat_samples`), taken at the timestamp `when`."""
+        table = self.table(term)
+        courses, statuses = table['courses'], table['statuses']
+        seconds = calendar.timegm(parse_timestamp(when).timetuple())
+
+        records = []
+        for course_id, total, registered, waitlist, status in samples:
+            if course_id not in table['course_ids']:
+                table['course_ids'][course_id] = len(courses)
+                courses.append(course_id)
+            if status not in statuses:
+                statuses.append(status)
+
+            course = table['course_ids'][course_id]
+            values = [-1 if count is None else count for count in (total, registered, waitlist)]
+            values.append(statuses.index(status))
+            if table['last'].get(course) == values:
+                continue
+
+            table['last'][course] = values
+            records.append(SAMPLE.pack(seconds, course, *values))
+
+        if not records:
+            return 0
+
+        # the tables are saved first, so that every sample can be resolved
+        save_manifest(self.folder / f'{term}.json', {'courses': courses, 'statuses': statuses})
+        with open(self.series_path(term), 'ab') as outfile:
+            outfile.write(b''.join(records))
+
+        return len(records)
+
+    def rows(self, term):
+        """Yields each sample of `term` as (timestamp, course id, total,
+        registered, waitlist, status)."""
+        table = self.table(term)
+        for seconds, course, total, registered, waitlist, status in self.samples(term):
+            when = datetime.datetime.utcfromtimestamp(seconds).strftime('%Y-%m-%dT%H:%M:%SZ')
+            counts = [None if count == -1 else count for count in (total, registered, waitlist)]
+            yield (when, table['courses'][course], *counts, table['statuses'][status])
 
-    time.sleep(delay)
 
-    return html
+def conditional_headers(previous):
+    headers = {}
+    if previous and previous.get('etag'):
+        headers['If-None-Match'] = previous['etag']
+    if previous and previous.get('last_modified'):
+        headers['If-Modified-Since'] = previous['last_modified']
+    return headers
 
 
-def cmd_fetch(*, args, root):
-    for term, subject in itertools.product(args.terms, args.subjects):
-        ident = f'{term}/{subject}'
+def page_entry(*, contents, response, courses):
+    return {
+        'courses': courses,
+        'etag': response.headers.get('ETag'),
+        'fetched': timestamp(),
+        'hash': hashlib.sha256(contents.encode('utf-8')).hexdigest(),
+        'last_modified': response.headers.get('Last-Modified'),
+        'size': len(contents),
+    }
+
+
+def settle_entry(entry, previous):
+    """Returns `previous` if `entry` only differs from it in when it was
+    fetched, so that the committed manifest only changes with the page."""
+    if previous and dict(entry, fetched=None) == dict(previous, fetched=None):
+        return previous
+    return entry
+
+
+def fetch_and_save(*, client, term, subject, store, previous=None, compact=False):
+    """Fetches a page and saves it, unless it is byte-identical to the copy
+    on disk. Returns a (status, manifest entry) tuple."""
+    headers = conditional_headers(previous)
+    html, response = fetch_subject_for_term(client=client, term=term, subject=subject,
+                                            headers=headers, compact=compact)
+
+    if html is None:
+        return 'not modified', previous
+
+    contents = html + '\n'
+    page = etree.fromstring(html, etree.HTMLParser()) if html.strip() else None
+    entry = page_entry(contents=contents, response=response, courses=count_courses(page))
+    entry = settle_entry(entry, previous)
+
+    status = 'saved' if store.write(term, subject, contents) else 'unchanged'
+    add_stat('pages_written', int(status == 'saved'))
+
+    return status, entry
+
+
+def fetch_and_extract(*, client, term, subject, root, store, previous=None, extracted=None, engine='lxml'):
+    """Fetches a page, then cleans it and extracts its courses from a single
+    lxml parse, saving both the HTML and the course files. Returns a
+    (status, fetch manifest entry, extract manifest entry, seat samples)
+    tuple, where the samples are None unless the courses were extracted.
+
+    The extract manifest entry names `engine`, the one `extract` is set to
+    use, since the engines give the same courses (see --check-parity), and
+    neither depends on whether the page is stored compact or prettified;
+    otherwise the next `extract` would parse every page all over again."""
+    response = client.get(term=term, subject=subject, headers=conditional_headers(previous))
+    if response.status_code == 304:
+        return 'not modified', previous, extracted, None
+
+    with timed('clean_seconds'):
+        page = etree.fromstring(response.text, etree.HTMLParser())
+        module = clean_tree(page)
+
+        # the stored HTML is the compact serialization of the very tree we
+        # extract from, so re-running `extract` over it later gives the same
+        # courses
+        contents = serialize_compact(module) + '\n'
+    entry = settle_entry(page_entry(contents=contents, response=response, courses=count_courses(page)), previous)
+
+    status = 'saved' if store.write(term, subject, contents) else 'unchanged'
+    add_stat('pages_written', int(status == 'saved'))
+
+    extract_entry = {'engine': engine, 'hash': entry['hash'], 'parser': PARSER_VERSION}
+    out_dir = root / 'courses' / term / subject
+    samples = None
+    if extract_entry != extracted or not out_dir.is_dir():
+        out_dir.mkdir(parents=True, exist_ok=True)
+        with timed('parse_seconds'):
+            courses = list(extract_courses_from_tree(root=page, term=term))
+        add_stat('courses', len(courses))
+        save_courses(courses=courses, out_dir=out_dir)
+        samples = seat_samples(courses)
+
+    return status, entry, extract_entry, samples
+
+
+class FetchJournal:
+    """A log of every page that fetch finished, or gave up on, in
+    `indices/<term>/.fetch-journal.jsonl`. Each record is written as soon as
+    the page is done, so after an interruption `--resume` can pick up with
+    just the pages that were never finished. A run without `--resume`
+    starts the journals of its terms afresh, and a term whose pages all
+    finished has its journal removed."""
+
+    def __init__(self, root, *, terms, resume=False):
+        self.paths = {term: root / 'indices' / term / '.fetch-journal.jsonl' for term in terms}
+        self.records = {term: self.load(path) if resume else {} for term, path in self.paths.items()}
+        self.files = {}
+
+        if not resume:
+            for path in self.paths.values():
+                if path.exists():
+                    path.unlink()
+
+    @staticmethod
+    def load(path):
+        records = {}
         try:
-            data = fetch_and_save(term=term,
-                           subject=subject,
-                           root=root,
-                           delay=args.delay)
+            with open(path, 'r') as infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line may have been cut short by a crash
+                        continue
+                    records[record['subject']] = record
+        except FileNotFoundError:
+            pass
+        return records
+
+    def is_done(self, term, subject):
+        return self.records[term].get(subject, {}).get('status') == 'done'
+
+    def record(self, term, subject, status, error=None):
+        if term not in self.files:
+            self.paths[term].parent.mkdir(parents=True, exist_ok=True)
+            self.files[term] = open(self.paths[term], 'a', buffering=1)
+
+        record = {'at': timestamp(), 'status': status, 'subject': subject}
+        if error:
+            record['error'] = error
+        self.records[term][subject] = record
+        self.files[term].write(json.dumps(record, sort_keys=True, ensure_ascii=False) + '\n')
+
+    def finish(self, term):
+        if not all(record['status'] == 'done' for record in self.records[term].values()):
+            return
+        if term in self.files:
+            self.files.pop(term).close()
+        if self.paths[term].exists():
+            self.paths[term].unlink()
+
+    def close(self):
+        for outfile in self.files.values():
+            outfile.close()
+
+
+def should_fetch(*, term, subject, entry, args, checked=None, today=None):
+    if args.force or not entry:
+        return True
+
+    if not is_closed_term(term, closed_after=args.closed_after, today=today):
+        return True
+
+    # most subjects didn't exist in every term, and a closed term won't grow
+    # new courses, so the pages that had none are only checked again every
+    # --reverify-empty days
+    refetch_after = args.reverify_empty if entry.get('courses') == 0 else args.refetch_closed
+    if refetch_after is None:
+        return False
+
+    # a manifest entry only changes along with its page, so the last time
+    # we asked about it may be more recent
+    today = today or datetime.date.today()
+    fetched = max(parse_timestamp(when).date() for when in (entry['fetched'], checked) if when)
+    if (today - fetched).days < refetch_after:
+        return False
+    if checked or refetch_after <= 1:
+        return True
+
+    # without a record of the last check (as in a fresh clone), a page that
+    # hasn't changed would be due on every run from now on, so each page
+    # gets its own day in every cycle of `refetch_after` days instead
+    slot = int(hashlib.sha256(f'{term}/{subject}'.encode('utf-8')).hexdigest(), 16) % refetch_after
+    return today.toordinal() % refetch_after == slot
+
+
+def cmd_fetch(*, args, root, extract=False):
+    """Fetches every term/subject page. With `extract`, it also extracts the
+    courses of each page as it arrives (see `fetch_and_extract`)."""
+    client = make_client(args)
+    store = IndexStore(root, kind=args.storage)
+    history = History(root)
+
+    # each term keeps a manifest of what we know about its pages, so that we
+    # can skip closed terms and send conditional requests
+    manifests = {term: load_manifest(root / 'indices' / term / '.fetch.json') for term in args.terms}
+    # when each page was last requested lives apart from the manifest, in a
+    # file that bin/fetch.sh leaves out of the data commits
+    checked = {term: load_manifest(root / 'indices' / term / '.fetch-checked.json') for term in args.terms}
+    extract_manifests = {}
+    if extract:
+        extract_manifests = {term: load_manifest(root / 'courses' / term / '.extract.json') for term in args.terms}
+    remaining = {term: 0 for term in args.terms}
+    skipped = 0
+    skipped_empty = 0
+    resumed = 0
+
+    journal = FetchJournal(root, terms=args.terms, resume=args.resume)
+
+    # the rate limiter keeps us polite; the workers only decide how many
+    # requests may be in flight at once
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for term, subject in itertools.product(args.terms, args.subjects):
+            if args.resume and journal.is_done(term, subject):
+                resumed += 1
+                continue
 
-            print(f'{ident} page is {len(data)} bytes')
-        except Exception as e:
-            print(f'{ident} generated an exception: {e}')
+            entry = manifests[term].get(subject)
+            if not store.exists(term, subject):
+                entry = None
 
+            if not should_fetch(term=term, subject=subject, entry=entry, args=args,
+                                checked=checked[term].get(subject)):
+                skipped += 1
+                skipped_empty += entry.get('courses') == 0
+                continue
 
-def clean_and_save(*, path: Path):
-    with open(path, 'r') as infile:
-        html = infile.read()
+            # --force means a full download, so we don't send the validators
+            # that would let Enroll answer "not modified"
+            previous = None if args.force else entry
+            if extract:
+                extracted = None if args.force else extract_manifests[term].get(subject)
+                key = executor.submit(instrumented, fetch_and_extract, profile=bool(args.profile),
+                                      client=client, term=term, subject=subject, root=root, store=store,
+                                      previous=previous, extracted=extracted, engine=args.engine)
+            else:
+                key = executor.submit(instrumented, fetch_and_save, profile=bool(args.profile),
+                                      client=client, term=term, subject=subject, store=store,
+                                      previous=previous, compact=args.compact_html)
+            futures[key] = (term, subject)
+            remaining[term] += 1
 
-    cleaned = clean_html(html)
+        if skipped:
+            print(f'skipped {skipped} pages from closed terms ({skipped_empty} of them without any courses)')
+        if resumed:
+            print(f'skipped {resumed} pages that the last run finished')
 
-    with open(path, 'w') as outfile:
-        outfile.write(cleaned)
-        outfile.write('\n')
+        try:
+            for future in as_completed(futures):
+                term, subject = futures[future]
+                ident = f'{term}/{subject}'
+                remaining[term] -= 1
+
+                # noinspection PyBroadException
+                try:
+                    status, entry, *extracted = args.metrics.unwrap(args.command, ident, future)
+                except Exception as e:
+                    print(f'{ident} generated an exception: {e}')
+                    journal.record(term, subject, 'failed', error=str(e) or type(e).__name__)
+                else:
+                    journal.record(term, subject, 'done')
+                    manifests[term][subject] = entry
+                    checked[term][subject] = timestamp()
+                    if extracted and extracted[0]:
+                        extract_manifests[term][subject] = extracted[0]
+                    if extracted and extracted[1]:
+                        history.append(term, extracted[1], when=entry['fetched'])
+                    if status == 'saved':
+                        print(f'{ident} page is {entry["size"]} bytes')
+                    else:
+                        print(f'{ident} page is {status}')
+
+                if not remaining[term]:
+                    save_manifest(root / 'indices' / term / '.fetch.json', manifests[term])
+                    save_manifest(root / 'indices' / term / '.fetch-checked.json', checked[term])
+                    if extract:
+                        save_manifest(root / 'courses' / term / '.extract.json', extract_manifests[term])
+
+            # nothing is left to resume, so there's no journal to commit
+            for term in args.terms:
+                journal.finish(term)
+        finally:
+            # if we were interrupted, don't start on anything new, and keep
+            # whatever we learned so far
+            for future in futures:
+                future.cancel()
+            journal.close()
+            for term, manifest in manifests.items():
+                if manifest:
+                    save_manifest(root / 'indices' / term / '.fetch.json', manifest)
+            for term, manifest in checked.items():
+                if manifest:
+                    save_manifest(root / 'indices' / term / '.fetch-checked.json', manifest)
+            for term, manifest in extract_manifests.items():
+                if manifest:
+                    save_manifest(root / 'courses' / term / '.extract.json', manifest)
+            store.close()
+
+
+def cmd_watch(*, args, root):
+    """Keeps polling the subjects of the watched terms, extracting each page
+    as it changes. Subjects whose pages change are polled again after
+    --poll-min seconds; every quiet poll doubles that, up to --poll-max."""
+    client = make_client(args)
+    store = IndexStore(root, kind=args.storage)
+    history = History(root)
+
+    manifests = {term: load_manifest(root / 'indices' / term / '.fetch.json') for term in args.terms}
+    extract_manifests = {term: load_manifest(root / 'courses' / term / '.extract.json') for term in args.terms}
+
+    # a heap of (when, term, subject) to poll next
+    queue = [(0, term, subject) for term, subject in itertools.product(args.terms, args.subjects)]
+    heapq.heapify(queue)
+    intervals = {}
+    rounds = 0
+
+    print(f'watching {len(queue)} pages from {", ".join(args.terms)}')
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            while not args.rounds or rounds < args.rounds:
+                now = time.monotonic()
+                if queue[0][0] > now:
+                    time.sleep(queue[0][0] - now)
+                    continue
+
+                due = []
+                while queue and queue[0][0] <= now:
+                    _, term, subject = heapq.heappop(queue)
+                    due.append((term, subject))
+
+                futures = {}
+                for term, subject in due:
+                    key = executor.submit(instrumented, fetch_and_extract, profile=bool(args.profile),
+                                          client=client, term=term, subject=subject, root=root, store=store,
+                                          previous=manifests[term].get(subject) if store.exists(term, subject) else None,
+                                          extracted=extract_manifests[term].get(subject), engine=args.engine)
+                    futures[key] = (term, subject)
+
+                changed_terms = set()
+                for future in as_completed(futures):
+                    term, subject = futures[future]
+                    ident = f'{term}/{subject}'
+                    interval = intervals.get((term, subject), args.poll_min)
+
+                    # noinspection PyBroadException
+                    try:
+                        status, entry, extracted, samples = args.metrics.unwrap('watch', ident, future)
+                    except Exception as e:
+                        print(f'{ident} generated an exception: {e}')
+                        interval = min(interval * 2, args.poll_max)
+                    else:
+                        manifests[term][subject] = entry
+                        if extracted:
+                            extract_manifests[term][subject] = extracted
+                        # history only records the sections that changed since
+                        # their last sample, so it can count them for us
+                        moved = history.append(term, samples, when=entry['fetched']) if samples else 0
+
+                        if status == 'saved':
+                            print(f'{ident} changed ({moved} sections have new seat counts or status)')
+                            changed_terms.add(term)
+                            interval = args.poll_min
+                        else:
+                            interval = min(interval * 2, args.poll_max)
+
+                    intervals[(term, subject)] = interval
+                    heapq.heappush(queue, (time.monotonic() + interval, term, subject))
+
+                for term in args.terms:
+                    save_manifest(root / 'indices' / term / '.fetch.json', manifests[term])
+                    save_manifest(root / 'courses' / term / '.extract.json', extract_manifests[term])
+
+                if changed_terms:
+                    cmd_bundle(args=args, root=root, terms=changed_terms)
+
+                rounds += 1
+                print(f'polled {len(due)} pages; next poll in {max(queue[0][0] - time.monotonic(), 0):.0f}s')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for term in args.terms:
+            if manifests[term]:
+                save_manifest(root / 'indices' / term / '.fetch.json', manifests[term])
+            if extract_manifests[term]:
+                save_manifest(root / 'courses' / term / '.extract.json', extract_manifests[term])
+        store.close()
+
+
+def clean_stored_page(*, store, term, subject, compact=False):
+    html = store.read(term, subject)
+    add_stat('bytes', len(html))
+    with timed('clean_seconds'):
+        return clean_html(html, compact=compact) + '\n'
 
 
 def cmd_clean(*, args, root):
-    index_dir = root / 'indices'
+    store = IndexStore(root, kind=args.storage)
 
     with ProcessPoolExecutor(max_workers=args.workers) as executor:
-        futures = {}
-        for subject_dir in [d for d in index_dir.glob('*/*') if d.is_dir()]:
-            path = subject_dir / '_index.html'
-            key = executor.submit(clean_and_save, path=path)
-            futures[key] = f'{subject_dir.parent.name}/{subject_dir.name}'
+        jobs = [((term, subject), store.size(term, subject),
+                 dict(store=store, term=term, subject=subject, compact=args.compact_html))
+                for term, subject in store.pages()]
+        futures = submit_batches(executor, clean_stored_page, jobs, workers=args.workers, profile=bool(args.profile))
 
-        for future in as_completed(futures):
-            ident = futures[future]
+        # the workers only clean; saving happens here, because several
+        # processes can't safely append to the same pack
+        try:
+            for (term, subject), outcome in iter_batches(futures):
+                ident = f'{term}/{subject}'
 
-            # noinspection PyBroadException
-            try:
-                future.result()
-            except Exception as e:
-                print(f'{ident} generated an exception: {e}')
-            else:
-                print(f'completed {ident}')
+                # noinspection PyBroadException
+                try:
+                    store.write(term, subject, args.metrics.take('clean', ident, outcome))
+                except Exception as e:
+                    print(f'{ident} generated an exception: {e}')
+                else:
+                    print(f'completed {ident}')
+        finally:
+            store.close()
 
 
-def extract_and_save(*, html_file: Path, out_dir: Path, term: str):
-    with open(html_file, 'r') as infile:
-        html = infile.read()
+def extract_and_save(*, store, subject: str, out_dir: Path, term: str, engine='bs4'):
+    html = store.read(term, subject)
+
+    with timed('parse_seconds'):
+        courses = list(extract_courses(html=html, term=term, engine=engine))
+    add_stat('courses', len(courses))
+
+    counts = save_courses(courses=courses, out_dir=out_dir)
+
+    return seat_samples(courses), counts
+
+
+def save_courses(*, courses, out_dir: Path):
+    """Saves each course as <number>.<section>.json, rewriting only the files
+    whose contents have changed, so that their mtimes (which the later steps
+    check) stay put. Returns how many files were written, left unchanged and
+    deleted."""
+    start = time.perf_counter()
+    counts = {'deleted': 0, 'unchanged': 0, 'written': 0}
 
     seen = set()
-    for course in extract_courses(html=html, term=term):
-        filename = out_dir / f'{course["number"]}.{course["section"]}.json'
-        with open(filename, 'w') as outfile:
-            json.dump(course, outfile, indent='\t', sort_keys=True, ensure_ascii=False)
-            outfile.write('\n')
-            seen.add(filename)
+    for course in courses:
+        filename = f'{course["number"]}.{course["section"]}.json'
+        contents = json.dumps(course, indent='\t', sort_keys=True, ensure_ascii=False) + '\n'
+        counts['written' if write_if_changed(out_dir / filename, contents) else 'unchanged'] += 1
+        seen.add(filename)
 
     # because we run per term, then per subject, we won't delete things that
     # aren't in the current run, but we will delete things that Carleton
     # doesn't list anymore. so we run the deletion at the end of
-    # `extract_and_save`.
-    exists = {file for file in out_dir.glob('*.json')}
-    to_delete = exists - seen
+    # `save_courses`.
+    for entry in os.scandir(out_dir):
+        if entry.name.endswith('.json') and entry.name not in seen:
+            os.unlink(entry.path)
+            counts['deleted'] += 1
+
+    add_stat('write_seconds', time.perf_counter() - start)
+    for name, count in counts.items():
+        add_stat(f'files_{name}', count)
+
+    return counts
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(chunk_size), b''):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def plan_extract(*, args, root):
+    """Decides which subject directories need to be (re-)extracted. Returns
+    the jobs to run, the per-term extract manifests, and how many were
+    skipped because neither their input nor the parser has changed."""
+    store = IndexStore(root)
+    files_dir = root / 'courses'
 
-    for file in to_delete:
-        file.unlink()
+    manifests = {}
+    jobs = []
+    skipped = 0
 
+    fetched = {}
+    for term, subject in store.pages(args.terms):
+        if term not in manifests:
+            manifests[term] = load_manifest(files_dir / term / '.extract.json')
+            fetched[term] = load_manifest(root / 'indices' / term / '.fetch.json')
 
-def cmd_extract(*, args, root):
-    index_dir = root / 'indices'
-    files_dir = root / 'courses'
+        out_dir = files_dir / term / subject
+        entry = {'engine': args.engine, 'hash': store.digest(term, subject), 'parser': PARSER_VERSION}
 
-    to_process = [d for d in index_dir.glob('*/*') if d.is_dir()]
+        if not args.force and out_dir.is_dir() and manifests[term].get(subject) == entry:
+            skipped += 1
+            continue
 
-    if args.debug:
-        for subject_dir in to_process:
-            html_file = subject_dir / '_index.html'
+        jobs.append({'term': term, 'subject': subject, 'store': store, 'out_dir': out_dir, 'entry': entry,
+                     'size': store.size(term, subject),
+                     # seat counts are as of when the page was fetched
+                     'fetched': fetched[term].get(subject, {}).get('fetched') or timestamp()})
 
-            term = subject_dir.parent.name
-            subject = subject_dir.name
-            if term not in args.terms:
-                continue
+    return jobs, manifests, skipped
 
-            out_dir = files_dir / term / subject
-            out_dir.mkdir(parents=True, exist_ok=True)
-
-            print(f'{subject_dir.parent.name}/{subject_dir.name}')
-            extract_and_save(html_file=html_file, out_dir=out_dir, term=term)
 
-        return
+def cmd_check_parity(*, args, root):
+    store = IndexStore(root)
+    to_check = store.pages(args.terms)
 
+    mismatched = 0
     with ProcessPoolExecutor(max_workers=args.workers) as executor:
         futures = {}
-        for subject_dir in to_process:
-            html_file = subject_dir / '_index.html'
-
-            term = subject_dir.parent.name
-            subject = subject_dir.name
-            if term not in args.terms:
-                continue
-
-            out_dir = files_dir / term / subject
-            out_dir.mkdir(parents=True, exist_ok=True)
-
-            key = executor.submit(extract_and_save, html_file=html_file, out_dir=out_dir, term=term)
-            futures[key] = f'{subject_dir.parent.name}/{subject_dir.name}'
+        for term, subject in to_check:
+            key = executor.submit(check_parity, store=store, term=term, subject=subject)
+            futures[key] = f'{term}/{subject}'
 
         for future in as_completed(futures):
             ident = futures[future]
 
             # noinspection PyBroadException
             try:
-                future.result()
+                differences = future.result()
             except Exception as e:
                 print(f'{ident} generated an exception: {e}')
-            else:
-                print(f'completed {ident}')
+                continue
 
+            if differences:
+                mismatched += 1
+            for difference in differences:
+                print(f'{ident} {difference}')
 
-def do_bundle(term, terms_dir):
-    subjects = []
+    print(f'{mismatched} of {len(to_check)} subjects differ between engines')
+    return mismatched == 0
 
-    for subject in [d for d in term.glob('*') if d.is_dir()]:
-        print(f'bundling term "{term.name}", subject "{subject.name}"', file=sys.stderr)
 
-        courses = []
-        for file in subject.glob('*.json'):
-            with open(file, 'r') as infile:
-                courses.append(json.load(infile))
+def cmd_extract(*, args, root, executor=None):
+    files_dir = root / 'courses'
 
-        subjects.append(courses)
+    if args.check_parity:
+        if not cmd_check_parity(args=args, root=root):
+            sys.exit(1)
+        return
 
-    # terms[term.name] = subjects
-    with open(terms_dir / f'{term.name}.json', 'w') as outfile:
+    jobs, manifests, skipped = plan_extract(args=args, root=root)
+    if skipped:
+        print(f'skipped {skipped} unchanged subjects')
+
+    history = History(root)
+
+    try:
+        if args.debug:
+            for job in jobs:
+                job['out_dir'].mkdir(parents=True, exist_ok=True)
+
+                ident = f'{job["term"]}/{job["subject"]}'
+                print(ident)
+                (samples, counts), stats = instrumented(extract_and_save, profile=bool(args.profile),
+                                                        store=job['store'], subject=job['subject'],
+                                                        out_dir=job['out_dir'], term=job['term'], engine=args.engine)
+                args.metrics.record('extract', ident, stats)
+                history.append(job['term'], samples, when=job['fetched'])
+                manifests[job['term']][job['subject']] = job['entry']
+
+            return
+
+        with process_pool(workers=args.workers, executor=executor) as executor:
+            for job in jobs:
+                job['out_dir'].mkdir(parents=True, exist_ok=True)
+
+            futures = submit_batches(executor, extract_and_save, [
+                (job, job['size'], dict(store=job['store'], subject=job['subject'], out_dir=job['out_dir'],
+                                        term=job['term'], engine=args.engine))
+                for job in jobs
+            ], workers=args.workers, profile=bool(args.profile))
+
+            for job, outcome in iter_batches(futures):
+                ident = f'{job["term"]}/{job["subject"]}'
+
+                # noinspection PyBroadException
+                try:
+                    samples, counts = args.metrics.take('extract', ident, outcome)
+                except Exception as e:
+                    print(f'{ident} generated an exception: {e}')
+                else:
+                    # only this process writes to history/, so the workers
+                    # hand their samples back instead
+                    history.append(job['term'], samples, when=job['fetched'])
+                    manifests[job['term']][job['subject']] = job['entry']
+                    print(f'completed {ident} ({counts["written"]} written, {counts["unchanged"]} unchanged, '
+                          f'{counts["deleted"]} deleted)')
+    finally:
+        for term, manifest in manifests.items():
+            if manifest:
+                save_manifest(files_dir / term / '.extract.json', manifest)
+
+
+def natural_key(text):
+    # sorts "9" before "10", and "100.01" before "100L.01"
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', text)]
+
+
+def iter_course_files(term):
+    """Yields (subject dir, course files) for a term, in subject/number/section order."""
+    for subject in sorted([d for d in term.glob('*') if d.is_dir()], key=lambda d: d.name):
+        yield subject, sorted(subject.glob('*.json'), key=lambda f: natural_key(f.stem))
+
+
+def flatten_course(course):
+    # eg: {"size": {"total": 30}} -> {"size.total": 30}
+    fields = {}
+    for key, value in course.items():
+        if isinstance(value, dict):
+            for subkey, subvalue in value.items():
+                fields[f'{key}.{subkey}'] = subvalue
+        else:
+            fields[key] = value
+    return fields
+
+
+def value_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:12]
+
+
+def fingerprint_course(course):
+    """Returns a short hash of each of a course's fields, or of each of their
+    fields for the ones that are objects, which is enough to tell what
+    changed without keeping the old course around."""
+    return {key: {subkey: value_hash(subvalue) for subkey, subvalue in value.items()}
+            if isinstance(value, dict) else value_hash(value)
+            for key, value in course.items()}
+
+
+def diff_course(old, new, course):
+    """Compares the fingerprints `old` and `new` (of `course`), and returns
+    the fields to `set` to their new values, and the ones to `unset`. Fields
+    that are objects before and after are compared field by field (as in
+    `size.registered`); any other change replaces the whole field."""
+    changes = {}
+    unset = []
+    for key, value in course.items():
+        if key not in old:
+            changes[key] = value
+        elif isinstance(old[key], dict) and isinstance(value, dict):
+            for subkey, subvalue in value.items():
+                if old[key].get(subkey) != new[key][subkey]:
+                    changes[f'{key}.{subkey}'] = subvalue
+            unset.extend(f'{key}.{subkey}' for subkey in old[key] if subkey not in value)
+        elif old[key] != new[key]:
+            changes[key] = value
+    unset.extend(key for key in old if key not in course)
+    return {'set': OrderedDict(sorted(changes.items())), 'unset': sorted(unset)}
+
+
+DELTA_VERSION = 2
+
+
+class DeltaBuilder:
+    """Compares the courses of a new bundle, as they stream past, against the
+    bundle it replaces. Rather than the old bundle itself, it reads the
+    fingerprints of its courses (see `fingerprint_course`) from a sidecar
+    file, and streams the new bundle's fingerprints into its replacement."""
+
+    def __init__(self, state_path, old_hash):
+        self.state_path = state_path
+        self.tmp_path = state_path.with_name(f'{state_path.name}.tmp')
+        self.old = self.load(state_path, old_hash) if old_hash else None
+        self.added = []
+        self.changed = {}
+        self.outfile = open(self.tmp_path, 'w')
+
+    @staticmethod
+    def load(path, bundle_hash):
+        # one [id, fingerprint] line per course, then {"hash": ...} of the
+        # bundle that they describe
+        courses = {}
+        try:
+            with open(path, 'r') as infile:
+                for line in infile:
+                    record = json.loads(line)
+                    if isinstance(record, dict):
+                        return courses if record.get('hash') == bundle_hash else None
+                    courses[record[0]] = record[1]
+        except (FileNotFoundError, ValueError):
+            pass
+        return None
+
+    def add(self, course):
+        new = fingerprint_course(course)
+        self.outfile.write(json.dumps([course['id'], new], sort_keys=True, ensure_ascii=False) + '\n')
+
+        if self.old is None:
+            return
+
+        old = self.old.pop(course['id'], None)
+        if old is None:
+            self.added.append(course)
+        elif old != new:
+            self.changed[course['id']] = diff_course(old, new, course)
+
+    def finish(self, new_hash):
+        """Saves the new fingerprints, and returns whether there is a patch."""
+        self.outfile.write(json.dumps({'hash': new_hash}) + '\n')
+        self.outfile.close()
+        os.replace(self.tmp_path, self.state_path)
+        return self.old is not None
+
+    def patch(self, *, old_hash, new_hash):
+        return {
+            'added': self.added,
+            'changed': OrderedDict(sorted(self.changed.items())),
+            'from': old_hash,
+            'removed': sorted(self.old),
+            'to': new_hash,
+        }
+
+
+def update_deltas(path, patch, history):
+    """Appends `patch` to the chain of patches in `path`, keeping the last
+    `history` of them. A client holding any bundle in the chain can catch
+    up by applying every patch from the one that starts at its hash."""
+    deltas = load_manifest(path)
+    patches = deltas.get('patches', [])
+    if deltas.get('version') != DELTA_VERSION or not patches or patches[-1]['to'] != patch['from']:
+        # the bundle was changed behind our back, so the old chain is useless
+        patches = []
+
+    patches = (patches + [patch])[-history:]
+    write_atomically(path, json.dumps({'patches': patches, 'to': patch['to'], 'version': DELTA_VERSION},
+                                      sort_keys=True, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+class ColumnBuilder:
+    """Collects courses into one array per field, replacing every string with
+    its index in a shared table of distinct strings. Nested objects become
+    dotted columns (`size.total`), and objects inside lists become tuples in
+    the key order listed under `tuples`."""
+
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.columns = {}
+        self.tuples = {}
+        self.count = 0
+
+    def intern(self, string):
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def encode(self, value, field):
+        if isinstance(value, str):
+            return self.intern(value)
+        if isinstance(value, list):
+            return [self.encode(item, field) for item in value]
+        if isinstance(value, dict):
+            keys = self.tuples.setdefault(field, sorted(value))
+            return [self.encode(value.get(key), field) for key in keys]
+        return value
+
+    def add(self, course):
+        fields = flatten_course(course)
+
+        for field in fields.keys() - self.columns.keys():
+            self.columns[field] = [None] * self.count
+
+        for field, column in self.columns.items():
+            column.append(self.encode(fields.get(field), field))
+
+        self.count += 1
+
+    def to_json(self):
+        return {
+            'columns': OrderedDict(sorted(self.columns.items())),
+            'count': self.count,
+            'strings': self.strings,
+            'tuples': OrderedDict(sorted(self.tuples.items())),
+            'version': 1,
+        }
+
+
+class IntervalBuilder:
+    """Collects the meetings of every section in a term into one list of
+    [start, end, section] sorted by start (see `meeting_intervals`), which is
+    enough to find overlaps with a binary search: a meeting overlapping
+    [s, e) must start before e, and no earlier than s - `max_length`."""
+
+    def __init__(self):
+        self.courses = []
+        self.intervals = []
+
+    def add(self, course):
+        intervals = (course.get('offerings') or {}).get('intervals') or []
+        if not intervals:
+            return
+
+        index = len(self.courses)
+        self.courses.append(course['id'])
+        self.intervals.extend([start, end, index] for start, end in intervals)
+
+    def to_json(self):
+        intervals = sorted(self.intervals)
+        return {
+            'courses': self.courses,
+            'intervals': intervals,
+            'max_length': max([end - start for start, end, _ in intervals], default=0),
+            'version': 1,
+        }
+
+
+SEARCH_FIELDS = ['title', 'summary', 'instructors']
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    # eg: "Café Society" -> ["cafe", "society"]
+    text = unicodedata.normalize('NFKD', text.lower())
+    return TOKEN_RE.findall(''.join(c for c in text if not unicodedata.combining(c)))
+
+
+class SearchBuilder:
+    """An inverted index of the words in each course's title, summary and
+    instructors. `tokens` is sorted, so that a prefix search is a binary
+    search for the range of tokens that start with it; `postings[i]` lists
+    (as indices into `courses`) the courses that contain `tokens[i]`."""
+
+    def __init__(self):
+        self.courses = []
+        self.postings = {}
+
+    def add(self, course):
+        index = len(self.courses)
+        self.courses.append(course['id'])
+
+        for field in SEARCH_FIELDS:
+            value = course.get(field) or ''
+            for text in (value if isinstance(value, list) else [value]):
+                for token in tokenize(text):
+                    postings = self.postings.setdefault(token, [])
+                    if not postings or postings[-1] != index:
+                        postings.append(index)
+
+    def merge(self, index):
+        """Adds the courses of another index's `to_json()`."""
+        offset = len(self.courses)
+        self.courses.extend(index['courses'])
+        for token, postings in zip(index['tokens'], index['postings']):
+            self.postings.setdefault(token, []).extend(offset + i for i in postings)
+
+    def to_json(self):
+        tokens = sorted(self.postings)
+        return {
+            'courses': self.courses,
+            'fields': SEARCH_FIELDS,
+            'postings': [self.postings[token] for token in tokens],
+            'tokens': tokens,
+            'version': 1,
+        }
+
+
+class ShardBuilder:
+    """Splits a term into one file per subject, named after a hash of its
+    contents (terms/<term>/<subject>.<hash>.json), so that a shard's URL
+    changes exactly when its contents do, and it can be cached forever.
+    `to_json()` maps each subject to its shard."""
+
+    def __init__(self, term, terms_dir):
+        self.term = term.name
+        self.folder = terms_dir / term.name
+        self.shards = {}
+        self.subject = None
+        self.texts = []
+
+    def add(self, course, subject):
+        if subject != self.subject:
+            self.flush()
+            self.subject = subject
+        self.texts.append(json.dumps(course, sort_keys=True, ensure_ascii=False, separators=(',', ':')))
+
+    def flush(self):
+        if self.subject is None:
+            return
+
+        contents = '[' + ','.join(self.texts) + ']\n'
+        digest = hashlib.sha256(contents.encode('utf-8')).hexdigest()
+        path = self.folder / f'{self.subject}.{digest[:16]}.json'
+        if not path.exists():
+            self.folder.mkdir(parents=True, exist_ok=True)
+            write_atomically(path, contents)
+
+        self.shards[self.subject] = {'hash': digest, 'path': f'terms/{self.term}/{path.name}'}
+        self.subject = None
+        self.texts = []
+
+    def finish(self):
+        """Writes the last shard, and deletes the ones that nothing refers to anymore."""
+        self.flush()
+        current = {Path(shard['path']).name for shard in self.shards.values()}
+        for file in (self.folder.iterdir() if self.folder.exists() else []):
+            if file.name not in current:
+                file.unlink()
+
+    def to_json(self):
+        return {'shards': OrderedDict(sorted(self.shards.items())), 'version': 1}
+
+
+def bundle_options(args):
+    return {'columnar': args.columnar, 'compact': args.compact_bundles, 'delta_history': args.delta_history,
+            'intervals': args.intervals, 'search': args.search or args.search_all, 'shards': args.shards}
+
+
+def do_bundle(term, terms_dir, compact=False, columnar=False, delta_history=0, intervals=False, search=False,
+              shards=False):
+    out_path = terms_dir / f'{term.name}.json'
+    # json_folder_map skips dotfiles, so a half-written bundle is never hashed
+    tmp_path = terms_dir / f'.{term.name}.json.tmp'
+    columns = ColumnBuilder() if columnar else None
+    meetings = IntervalBuilder() if intervals else None
+    words = SearchBuilder() if search else None
+    subjects = ShardBuilder(term, terms_dir) if shards else None
+
+    delta_path = terms_dir / f'{term.name}.delta.json'
+    state_path = terms_dir / f'.{term.name}.fingerprints.jsonl'
+    old_hash = hash_file(out_path) if delta_history else None
+    delta = DeltaBuilder(state_path, old_hash) if delta_history else None
+
+    # courses are streamed into the bundle one at a time, so memory use
+    # doesn't depend on the size of the term
+    with open(tmp_path, 'w') as outfile:
         print(f'saving {term.name} bundle')
-        all_courses = [courses_set for subject in subjects for courses_set in subject]
-        json.dump(all_courses, outfile, indent='\t', sort_keys=True, ensure_ascii=False)
-        outfile.write('\n')
+        outfile.write('[')
+
+        count = 0
+        for subject, files in iter_course_files(term):
+            print(f'bundling term "{term.name}", subject "{subject.name}"', file=sys.stderr)
+
+            for file in files:
+                with open(file, 'r') as infile:
+                    course = json.load(infile)
+
+                if compact:
+                    text = json.dumps(course, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+                else:
+                    # matches what json.dump(all_courses, indent='\t') would produce
+                    text = '\n\t' + json.dumps(course, indent='\t', sort_keys=True, ensure_ascii=False).replace('\n', '\n\t')
+
+                outfile.write(text if not count else ',' + text)
+                count += 1
+
+                if columns:
+                    columns.add(course)
+                if meetings:
+                    meetings.add(course)
+                if words:
+                    words.add(course)
+                if subjects:
+                    subjects.add(course, subject.name)
+                if delta:
+                    delta.add(course)
+
+        outfile.write('\n]\n' if count and not compact else ']\n')
+
+    os.replace(tmp_path, out_path)
+    add_stat('courses', count)
+    add_stat('bytes', out_path.stat().st_size)
+
+    if delta:
+        new_hash = hash_file(out_path)
+        if delta.finish(new_hash) and new_hash != old_hash:
+            update_deltas(delta_path, delta.patch(old_hash=old_hash, new_hash=new_hash), delta_history)
+    else:
+        for path in [delta_path, state_path]:
+            if path.exists():
+                path.unlink()
+
+    if subjects:
+        subjects.finish()
+    elif (terms_dir / term.name).is_dir():
+        shutil.rmtree(terms_dir / term.name)
+
+    for artifact, builder in [('columns', columns), ('intervals', meetings), ('search', words), ('shards', subjects)]:
+        path = terms_dir / f'{term.name}.{artifact}.json'
+        if builder:
+            write_atomically(path, json.dumps(builder.to_json(), ensure_ascii=False, separators=(',', ':')) + '\n')
+        elif path.exists():
+            path.unlink()
+
+
+def bundle_signature(term, **options):
+    """A fingerprint of a term's course files and of the options its bundle
+    is built with. It only depends on what the files hold, so a fresh clone
+    or a `touch` doesn't rebuild anything: a subject is known by the page
+    and parser its courses were extracted with (from `.extract.json`), or,
+    if it has no entry there, by the contents of its files."""
+    extracted = load_manifest(term / '.extract.json')
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode('utf-8'))
+    for subject, files in iter_course_files(term):
+        entry = extracted.get(subject.name)
+        if entry:
+            source = f'{entry["hash"]} {entry["parser"]}'
+        else:
+            source = ' '.join(hash_file(file) for file in files)
+        names = ' '.join(file.name for file in files)
+        digest.update(f'{subject.name} {source} {names}\n'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def build_combined_search(terms_dir):
+    """Merges the search index of every term into all.search.json."""
+    index = SearchBuilder()
+    paths = [path for path in terms_dir.glob('*.search.json') if TERM_RE.match(path.name.split('.')[0])]
+    for path in sorted(paths, key=lambda path: term_code(path.name.split('.')[0])):
+        with open(path, 'r') as infile:
+            index.merge(json.load(infile))
+
+    write_atomically(terms_dir / 'all.search.json',
+                     json.dumps(index.to_json(), ensure_ascii=False, separators=(',', ':')) + '\n')
+    print('saving combined search index')
+
 
+def publish_terms(*, args, terms_dir, rebuilt):
+    """Writes the combined search index and info.json. `rebuilt` names the
+    terms that bundle just wrote; every other file is as bundle left it."""
+    combined = terms_dir / 'all.search.json'
+    if args.search_all and (rebuilt or not combined.exists()):
+        build_combined_search(terms_dir)
+        rebuilt = set(rebuilt) | {'all'}
+    elif not args.search_all and combined.exists():
+        combined.unlink()
 
-def cmd_bundle(*, args, root):
-    terms = {}
+    kept = [file.name for file in terms_dir.iterdir() if file.name.split('.')[0] not in rebuilt]
+    json_folder_map(folder=terms_dir, name='info', workers=args.workers, force=args.force, kept=kept)
 
+
+def cmd_bundle(*, args, root, executor=None, terms=None):
     terms_dir = root / 'terms'
     terms_dir.mkdir(exist_ok=True)
 
     files_dir = root / 'courses'
 
-    if args.debug:
-        for term in [d for d in files_dir.glob('*') if d.is_dir()]:
-            do_bundle(term=term, terms_dir=terms_dir)
-
-        json_folder_map(folder=terms_dir, name='info')
+    # only rebuild the bundles whose course files have changed
+    cache = load_manifest(terms_dir / '.bundle.json')
+    to_bundle = {}
+    candidates = [d for d in files_dir.glob('*') if d.is_dir() and (terms is None or d.name in terms)]
+    for term in candidates:
+        signature = bundle_signature(term, **bundle_options(args))
+        if not args.force and cache.get(term.name) == signature and (terms_dir / f'{term.name}.json').exists():
+            continue
+        to_bundle[term] = signature
+
+    skipped = len(candidates) - len(to_bundle)
+    if skipped:
+        print(f'skipped {skipped} unchanged terms')
+
+    try:
+        if args.debug:
+            for term, signature in to_bundle.items():
+                _, stats = instrumented(do_bundle, profile=bool(args.profile),
+                                        term=term, terms_dir=terms_dir, **bundle_options(args))
+                args.metrics.record('bundle', term.name, stats)
+                cache[term.name] = signature
+
+            publish_terms(args=args, terms_dir=terms_dir, rebuilt={term.name for term in to_bundle})
+
+            return
+
+        with process_pool(workers=args.workers, executor=executor) as executor:
+            futures = submit_batches(executor, do_bundle, [
+                (term, sum(file.stat().st_size for file in term.glob('*/*.json')),
+                 dict(term=term, terms_dir=terms_dir, **bundle_options(args)))
+                for term in to_bundle
+            ], workers=args.workers, profile=bool(args.profile))
+
+            for term, outcome in iter_batches(futures):
+                ident = term.name
+
+                # noinspection PyBroadException
+                try:
+                    args.metrics.take('bundle', ident, outcome)
+                except Exception as e:
+                    print(f'{ident} generated an exception: {e}')
+                else:
+                    cache[term.name] = to_bundle[term]
+                    print(f'completed {ident}')
+    finally:
+        save_manifest(terms_dir / '.bundle.json', cache)
+
+    publish_terms(args=args, terms_dir=terms_dir, rebuilt={term.name for term in to_bundle})
+
+
+def cmd_history(*, args, root):
+    """Prints the seat counts recorded for the given terms as CSV."""
+    history = History(root)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['time', 'course', 'total', 'registered', 'waitlist', 'status'])
+
+    for term in args.terms:
+        for row in history.rows(term):
+            if args.course and args.course not in row[1]:
+                continue
+            writer.writerow(row)
 
-        return
 
+def cmd_build(*, args, root):
+    """Extracts, then bundles, with one pool of workers for both."""
     with ProcessPoolExecutor(max_workers=args.workers) as executor:
-        futures = {}
+        cmd_extract(args=args, root=root, executor=executor)
+        cmd_bundle(args=args, root=root, executor=executor)
+
+
+# bump this whenever DB_SCHEMA changes; older databases are rebuilt from scratch
+DB_VERSION = 1
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    term TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    signature TEXT NOT NULL,
+    PRIMARY KEY (term, subject)
+);
+CREATE TABLE IF NOT EXISTS courses (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL,
+    term TEXT NOT NULL,
+    source TEXT NOT NULL,
+    term_code INTEGER NOT NULL,
+    year INTEGER,
+    semester TEXT,
+    subject TEXT NOT NULL,
+    number TEXT,
+    section TEXT,
+    title TEXT,
+    type TEXT,
+    status TEXT,
+    credits REAL,
+    synonym TEXT,
+    summary TEXT,
+    prerequisites TEXT,
+    comments TEXT,
+    scnc INTEGER,
+    size_total INTEGER,
+    size_registered INTEGER,
+    size_waitlist INTEGER
+);
+CREATE TABLE IF NOT EXISTS instructors (
+    course INTEGER NOT NULL REFERENCES courses (rowid) ON DELETE CASCADE,
+    name TEXT NOT NULL COLLATE NOCASE
+);
+CREATE TABLE IF NOT EXISTS times (
+    course INTEGER NOT NULL REFERENCES courses (rowid) ON DELETE CASCADE,
+    day TEXT,
+    start TEXT,
+    end TEXT,
+    start_minute INTEGER,
+    end_minute INTEGER
+);
+CREATE TABLE IF NOT EXISTS locations (
+    course INTEGER NOT NULL REFERENCES courses (rowid) ON DELETE CASCADE,
+    location TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tags (
+    course INTEGER NOT NULL REFERENCES courses (rowid) ON DELETE CASCADE,
+    tag TEXT NOT NULL COLLATE NOCASE
+);
+CREATE TABLE IF NOT EXISTS requirements (
+    course INTEGER NOT NULL REFERENCES courses (rowid) ON DELETE CASCADE,
+    requirement TEXT NOT NULL COLLATE NOCASE
+);
+CREATE INDEX IF NOT EXISTS courses_id ON courses (id);
+CREATE INDEX IF NOT EXISTS courses_source ON courses (term, source);
+CREATE INDEX IF NOT EXISTS courses_subject ON courses (subject, number);
+CREATE INDEX IF NOT EXISTS courses_term ON courses (term_code, subject);
+CREATE INDEX IF NOT EXISTS instructors_name ON instructors (name, course);
+CREATE INDEX IF NOT EXISTS instructors_course ON instructors (course);
+CREATE INDEX IF NOT EXISTS times_day ON times (day, start_minute, end_minute);
+CREATE INDEX IF NOT EXISTS times_course ON times (course);
+CREATE INDEX IF NOT EXISTS locations_course ON locations (course);
+CREATE INDEX IF NOT EXISTS tags_tag ON tags (tag, course);
+CREATE INDEX IF NOT EXISTS tags_course ON tags (course);
+CREATE INDEX IF NOT EXISTS requirements_requirement ON requirements (requirement, course);
+CREATE INDEX IF NOT EXISTS requirements_course ON requirements (course);
+"""
+
+
+def open_db(path):
+    db = sqlite3.connect(str(path))
+    db.execute('PRAGMA foreign_keys = ON')
+
+    # the database only mirrors the course files, so it is cheaper to reload
+    # an old one than to migrate it
+    if db.execute('PRAGMA user_version').fetchone()[0] != DB_VERSION:
+        for table in ['requirements', 'tags', 'locations', 'times', 'instructors', 'courses', 'sources']:
+            db.execute(f'DROP TABLE IF EXISTS {table}')
+        db.execute(f'PRAGMA user_version = {DB_VERSION}')
+
+    db.executescript(DB_SCHEMA)
+    return db
+
+
+def subject_signature(files):
+    # stat()ing is enough to notice that extract has rewritten a subject
+    digest = hashlib.sha256()
+    for file in files:
+        stat = file.stat()
+        digest.update(f'{file.name}:{stat.st_size}:{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def insert_course(db, course, term, source):
+    size = course.get('size') or {}
+    offerings = course.get('offerings') or {}
+
+    row = db.execute(
+        'INSERT INTO courses (id, term, source, term_code, year, semester, subject, number, section, title, type, '
+        'status, credits, synonym, summary, prerequisites, comments, scnc, size_total, size_registered, size_waitlist) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (course['id'], term, source, term_code(term), course.get('year'), course.get('semester'), course['subject'],
+         course.get('number'), course.get('section'), course.get('title'), course.get('type'), course.get('status'),
+         course.get('credits'), course.get('synonym'), course.get('summary'), course.get('prerequisites'),
+         '\n'.join(course.get('comments') or []) or None, course.get('scnc'),
+         size.get('total'), size.get('registered'), size.get('waitlist'))).lastrowid
+
+    db.executemany('INSERT INTO instructors (course, name) VALUES (?, ?)',
+                   [(row, name) for name in course.get('instructors') or []])
+    db.executemany('INSERT INTO times (course, day, start, end, start_minute, end_minute) VALUES (?, ?, ?, ?, ?, ?)',
+                   [(row, t.get('day'), t.get('start'), t.get('end'), clock_minutes(t.get('start')), clock_minutes(t.get('end')))
+                    for t in offerings.get('times') or []])
+    db.executemany('INSERT INTO locations (course, location) VALUES (?, ?)',
+                   [(row, location) for location in offerings.get('locations') or []])
+    db.executemany('INSERT INTO tags (course, tag) VALUES (?, ?)',
+                   [(row, tag) for tag in course.get('tags') or []])
+    db.executemany('INSERT INTO requirements (course, requirement) VALUES (?, ?)',
+                   [(row, requirement) for requirement in course.get('requirements') or []])
+
+
+def cmd_db(*, args, root):
+    files_dir = root / 'courses'
+    db = open_db(args.db or root / 'courses.db')
 
-        for term in [d for d in files_dir.glob('*') if d.is_dir()]:
-            key = executor.submit(do_bundle, term=term, terms_dir=terms_dir)
-            futures[key] = term.name
+    sources = {(term, subject): signature
+               for term, subject, signature in db.execute('SELECT term, subject, signature FROM sources')}
 
-        for future in as_completed(futures):
-            ident = futures[future]
+    updated = skipped = removed = 0
+    for term_name in args.terms:
+        term = files_dir / term_name
+        seen = set()
 
+        for subject, files in (iter_course_files(term) if term.is_dir() else []):
+            key = (term_name, subject.name)
+            seen.add(key)
+
+            signature = subject_signature(files)
+            if not args.force and sources.get(key) == signature:
+                skipped += 1
+                continue
+
+            # each subject is replaced in its own transaction, so an
+            # interrupted run (or a bad file) leaves the database consistent.
+            # Its rows are found by the folder they came from, since a
+            # course's own subject may differ (e.g. cross-listings).
             # noinspection PyBroadException
             try:
-                future.result()
-            except Exception as e:
-                print(f'{ident} generated an exception: {e}')
-            else:
-                print(f'completed {ident}')
+                with db:
+                    db.execute('DELETE FROM courses WHERE term = ? AND source = ?', key)
+                    for file in files:
+                        with open(file, 'r') as infile:
+                            insert_course(db, json.load(infile), term_name, subject.name)
+                    db.execute('INSERT OR REPLACE INTO sources (term, subject, signature) VALUES (?, ?, ?)',
+                               key + (signature,))
+            except (sqlite3.Error, ValueError, KeyError) as e:
+                print(f'{term_name}/{subject.name} generated an exception: {e}')
+                continue
+
+            print(f'loaded {term_name}/{subject.name}')
+            updated += 1
+
+        # forget subjects that are no longer on disk
+        for key in [k for k in sources if k[0] == term_name and k not in seen]:
+            with db:
+                db.execute('DELETE FROM courses WHERE term = ? AND source = ?', key)
+                db.execute('DELETE FROM sources WHERE term = ? AND subject = ?', key)
+            removed += 1
+
+    with db:
+        db.execute('ANALYZE')
+    db.close()
+
+    print(f'loaded {updated} subjects, skipped {skipped} unchanged, removed {removed}')
+
+
+def cmd_query(*, args, root, terms=None):
+    db = open_db(args.db or root / 'courses.db')
+
+    if args.sql:
+        cursor = db.execute(args.sql)
+        if cursor.description:
+            print('\t'.join(column[0] for column in cursor.description))
+        for row in cursor:
+            print('\t'.join('' if value is None else str(value) for value in row))
+        db.close()
+        return
+
+    clauses = []
+    params = []
+    if terms:
+        clauses.append(f'c.term IN ({", ".join("?" * len(terms))})')
+        params += terms
+    if args.subjects:
+        clauses.append(f'c.subject IN ({", ".join("?" * len(args.subjects))})')
+        params += args.subjects
+    if args.instructor:
+        clauses.append('c.rowid IN (SELECT course FROM instructors WHERE name = ?)')
+        params.append(args.instructor)
+    if args.requirement:
+        clauses.append('c.rowid IN (SELECT course FROM requirements WHERE requirement = ?)')
+        params.append(args.requirement)
+    if args.tag:
+        clauses.append('c.rowid IN (SELECT course FROM tags WHERE tag = ?)')
+        params.append(args.tag)
+    if args.day or args.at:
+        meeting = []
+        if args.day:
+            meeting.append('day = ?')
+            params.append(args.day)
+        if args.at:
+            hour, minute = datetime.datetime.strptime(args.at, '%H:%M').timetuple()[3:5]
+            minute = hour * 60 + minute
+            meeting.append('start_minute <= ? AND end_minute > ?')
+            params += [minute, minute]
+        clauses.append(f'c.rowid IN (SELECT course FROM times WHERE {" AND ".join(meeting)})')
+
+    where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+    query = (f'SELECT c.id, c.title, (SELECT group_concat(name, ", ") FROM instructors WHERE course = c.rowid) '
+             # a cross-listed course is stored once per subject page it is on
+             f'FROM courses c {where} GROUP BY c.id ORDER BY c.term_code, c.subject, c.number, c.section')
+
+    count = 0
+    for course_id, title, instructors in db.execute(query, params):
+        print(f'{course_id}\t{title}\t{instructors or ""}')
+        count += 1
+    db.close()
+
+    print(f'{count} sections', file=sys.stderr)
+
+
+BENCH_INSTRUCTORS = ['Anna Moltke', 'David Liben-Nowell', 'Jeff Ondich', 'Layla Oesper', 'Sneha Chaudhari',
+                     'Amy Csizmar Dalal', 'Eric Alexander', 'Deborah Gross', 'Jorge Brea', 'Rika Anderson']
+BENCH_WORDS = ['introduction', 'advanced', 'topics', 'in', 'computation', 'theory', 'and', 'practice', 'of',
+               'systems', 'seminar', 'history', 'literature', 'methods', 'analysis', 'modern', 'language']
+BENCH_ROOMS = ['CMC 102', 'CMC 206', 'Hulings 120', 'Leighton 304', 'Weitz 236', 'Olin 141', 'Boliou 104']
+BENCH_TAGS = ['QRE', 'WR2', 'IDS', 'FL', 'HUM', 'LAB']
+BENCH_REQUIREMENTS = ['FSR', 'HI', 'LA', 'LS', 'PE', 'SI', 'AR']
+
+
+def generate_course_html(*, subject, number, section, rng):
+    """Returns one `.course` block, shaped like the ones Enroll serves."""
+    words = lambda n: ' '.join(rng.choice(BENCH_WORDS) for _ in range(n))
+
+    parts = [f'<h3 class="title"><span class="coursenum">{subject} {number}.{section}</span> {words(4).title()}</h3>']
+
+    if rng.random() < 0.9:
+        names = rng.sample(BENCH_INSTRUCTORS, rng.choice([1, 1, 1, 2, 3]))
+        links = ', '.join(f'<a href="/people/{i}/">{name}</a>' for i, name in enumerate(names))
+        parts.append(f'<p class="faculty">{links}</p>{words(30).capitalize()}.')
+    else:
+        parts.append(f'<p class="description">{words(30).capitalize()}.</p>')
+
+    if rng.random() < 0.4:
+        parts.append(f'<p class="prereq">Prerequisite: {subject} {rng.randint(100, 299)} or instructor permission</p>')
+    for _ in range(rng.choice([0, 0, 1, 2])):
+        parts.append(f'<p class="comments">{words(8).capitalize()} <em>{words(2)}</em></p>')
+
+    total = rng.choice([12, 20, 25, 30, 35, 60])
+    registered = rng.randint(0, total)
+    status = 'Open' if registered < total else rng.choice(['Closed', 'Waitlist'])
+    parts.append(f'<p class="status"><span class="statusName">{status}:</span> '
+                 f'Size: {total}, Registered: {registered}, Waitlist: {rng.randint(0, 10)}</p>')
+
+    tags = ''.join(f'<a href="?other_code[]={code}">{code}</a>' for code in rng.sample(BENCH_TAGS, rng.randint(0, 2)))
+    parts.append(f'<div class="codes gov_codes">{tags}</div>')
+    reqs = ''.join(f'<a href="?requirements[]={code}">{code}</a>'
+                   for code in rng.sample(BENCH_REQUIREMENTS, rng.randint(0, 2)))
+    parts.append(f'<div class="codes overlays">{reqs}</div>')
+
+    scnc = ' <abbr title="S/CR/NC">S/CR/NC</abbr>' if rng.random() < 0.2 else ''
+    parts.append(f'<p class="credits">{rng.choice([2, 3, 6, 6, 6])} credits{scnc}</p>')
+    parts.append(f'<p class="textbooks"><a href="#">Textbooks</a> Synonym: {rng.randint(10000, 99999)}</p>')
+
+    if rng.random() < 0.95:
+        # there is at least one course that occurs on Saturday, and Enroll
+        # then switches to a seven-day table
+        days = ['Su', 'Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa'] if rng.random() < 0.03 else ['Mo', 'Tu', 'We', 'Th', 'Fr', 'Sa']
+        meets = rng.choice([['Mo', 'We', 'Fr'], ['Tu', 'Th'], ['Mo'], ['Sa']])
+        hour = rng.randint(8, 15)
+        cells = ''.join(f'<td><span class="start">{hour % 12 or 12}:10 {"AM" if hour < 12 else "PM"}</span>'
+                        f'<span class="end">{(hour + 1) % 12 or 12}:20 {"AM" if hour + 1 < 12 else "PM"}</span></td>'
+                        if day in meets else '<td></td>' for day in days)
+        header = ''.join(f'<th>{day}</th>' for day in days)
+        parts.append(f'<div class="schedule"><table><tr>{header}</tr><tr>{cells}</tr></table></div>')
+        rooms = ''.join(f'<a href="#">{room}</a>' for room in rng.sample(BENCH_ROOMS, rng.choice([1, 1, 2])))
+        parts.append(f'<p class="locations">{rooms}</p>')
+    else:
+        parts.append('<div class="schedule"></div>')
+
+    return '<div class="course">' + '\n'.join(parts) + '</div>'
+
+
+def generate_enroll_page(*, term, subject, courses, rng):
+    """Returns a whole Enroll search result page, with `courses` courses."""
+    blocks = []
+    for i in range(courses):
+        number = f'{100 + i * 3}{rng.choice(["", "", "", "", "L", "J", "F", "S"])}'
+        blocks.append(generate_course_html(subject=subject, number=number, section=f'{i % 3 + 1:02}', rng=rng))
+
+    return (f'<!DOCTYPE html><html><head><title>Enroll</title></head><body>'
+            f'<div id="enrollModule"><div id="myCourses"><h3>My Courses</h3></div>'
+            f'<p class="searchDescription">Your search for courses for {term} and {subject} found {courses} courses.</p>'
+            f'<div class="courses">\n' + '\n'.join(blocks) + '\n</div>'
+            f'<form id="disco_form"><input name="term" value="{term}"></form></div></body></html>')
+
 
-    json_folder_map(folder=terms_dir, name='info')
+def generate_corpus(*, root, terms, subjects, courses, seed=0):
+    """Writes raw pages to `root/raw` and cleaned ones to `root/indices`."""
+    rng = random.Random(seed)
+    for term, subject in itertools.product(terms, subjects):
+        html = generate_enroll_page(term=term, subject=subject, courses=courses, rng=rng)
+
+        raw = root / 'raw' / term / f'{subject}.html'
+        raw.parent.mkdir(parents=True, exist_ok=True)
+        with open(raw, 'w') as outfile:
+            outfile.write(html)
+
+        cleaned = root / 'indices' / term / subject / '_index.html'
+        cleaned.parent.mkdir(parents=True, exist_ok=True)
+        with open(cleaned, 'w') as outfile:
+            outfile.write(clean_html(html))
+            outfile.write('\n')
+
+
+def bench_stage(*, stage, root):
+    """Runs one benchmark stage over the corpus in `root`. It is meant to run
+    in a fresh process, so that its peak RSS is its own."""
+    import resource
+
+    raw_pages = sorted((root / 'raw').glob('*/*.html'))
+    store = IndexStore(root)
+    pages = 0
+    courses = 0
+
+    # every engine has to write all of its files, rather than finding most of
+    # them already there from the stage before
+    if stage.startswith('extract_and_save:') and (root / 'courses').exists():
+        shutil.rmtree(root / 'courses')
+
+    start = time.perf_counter()
+
+    if stage == 'clean_html':
+        for path in raw_pages:
+            with open(path, 'r') as infile:
+                clean_html(infile.read())
+            pages += 1
+    elif stage == 'clean_tree':
+        for path in raw_pages:
+            with open(path, 'r') as infile:
+                serialize_compact(clean_tree(etree.fromstring(infile.read(), etree.HTMLParser())))
+            pages += 1
+    elif stage.startswith('extract_courses:'):
+        engine = stage.split(':')[1]
+        for term, subject in store.pages():
+            courses += len(list(extract_courses(html=store.read(term, subject), term=term, engine=engine)))
+            pages += 1
+    elif stage.startswith('extract_and_save:'):
+        engine = stage.split(':')[1]
+        for term, subject in store.pages():
+            out_dir = root / 'courses' / term / subject
+            out_dir.mkdir(parents=True, exist_ok=True)
+            extract_and_save(store=store, subject=subject, out_dir=out_dir, term=term, engine=engine)
+            courses += len(list(out_dir.glob('*.json')))
+            pages += 1
+    elif stage == 'do_bundle':
+        terms_dir = root / 'terms'
+        terms_dir.mkdir(exist_ok=True)
+        for term in sorted(d for d in (root / 'courses').glob('*') if d.is_dir()):
+            # do_bundle narrates its progress, which would drown out the results
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+                do_bundle(term=term, terms_dir=terms_dir)
+            courses += len(list(term.glob('*/*.json')))
+            pages += len([d for d in term.glob('*') if d.is_dir()])
+    else:
+        raise ValueError(f'unknown benchmark stage {stage!r}')
+
+    seconds = time.perf_counter() - start
+
+    return {
+        'courses': courses,
+        'courses_per_sec': round(courses / seconds, 1) if courses else None,
+        'pages': pages,
+        'pages_per_sec': round(pages / seconds, 1),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'seconds': round(seconds, 4),
+    }
+
+
+BENCH_STAGES = ['clean_html', 'clean_tree', 'extract_courses:bs4', 'extract_courses:lxml',
+                'extract_and_save:bs4', 'extract_and_save:lxml', 'do_bundle']
+
+
+def cmd_bench(*, args):
+    terms = args.terms[:2] or ['18FA']
+    subjects = [f'S{i:03}' for i in range(args.bench_pages // len(terms) or 1)]
+
+    results_path = Path(args.bench_results)
+    history = []
+    if results_path.exists():
+        with open(results_path, 'r') as infile:
+            history = [json.loads(line) for line in infile if line.strip()]
+
+    run = {
+        'courses_per_page': args.bench_courses,
+        'pages': len(terms) * len(subjects),
+        'python': sys.version.split()[0],
+        'stages': OrderedDict(),
+        'timestamp': timestamp(),
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        print(f'generating {run["pages"]} pages of {args.bench_courses} courses')
+        generate_corpus(root=workdir, terms=terms, subjects=subjects, courses=args.bench_courses)
+
+        for stage in BENCH_STAGES:
+            # one fresh process per stage, so each one's peak RSS is its own
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(bench_stage, stage=stage, root=workdir).result()
+            run['stages'][stage] = result
+
+    previous = next((r for r in reversed(history)
+                     if r['pages'] == run['pages'] and r['courses_per_page'] == run['courses_per_page']), None)
+
+    for stage, result in run['stages'].items():
+        rate, unit = (result['courses_per_sec'], 'courses/s') if result['courses_per_sec'] else (result['pages_per_sec'], 'pages/s')
+        line = f'{stage:<24} {rate:>10.1f} {unit:<10} {result["peak_rss_kb"] / 1024:>8.1f} MiB peak'
+
+        before = previous and previous['stages'].get(stage)
+        if before:
+            old_rate = before['courses_per_sec'] if result['courses_per_sec'] else before['pages_per_sec']
+            if old_rate:
+                line += f'  ({(rate - old_rate) / old_rate:+.1%} vs {previous["timestamp"]})'
+
+        print(line)
+
+    with open(results_path, 'a') as outfile:
+        outfile.write(json.dumps(run, ensure_ascii=False) + '\n')
+
+    print('Wrote', results_path)
+
+
+ONLINE_COMMANDS = ['fetch', 'pipeline', 'watch']
 
 
 def main():
     parser = ArgumentParser()
     parser.add_argument('command', action='store',
-                        choices=['fetch', 'clean', 'extract', 'bundle'],
+                        choices=['fetch', 'clean', 'extract', 'bundle', 'build', 'pipeline', 'watch', 'db', 'query', 'history',
+                                 'bench', 'serve'],
                         help='Which command to execute')
     parser.add_argument('terms', action='store', nargs='*', metavar='TERM',
                         help='A term, like 18WI or 15SP')
@@ -560,6 +3230,114 @@ def main():
     parser.add_argument('--delay', action='store',
                         type=float, default=0.5,
                         help='Control the delay between term/subject fetches, in seconds (be nice)')
+    parser.add_argument('--rate', action='store', metavar='N',
+                        type=float, default=None,
+                        help='Allow at most N requests per second to Enroll (overrides --delay)')
+    parser.add_argument('--burst', action='store', metavar='N',
+                        type=int, default=1,
+                        help='Allow up to N requests to be sent back-to-back before --rate applies')
+    parser.add_argument('--retries', action='store', metavar='N',
+                        type=int, default=3,
+                        help='Retry requests that fail in a way that might be temporary up to N times')
+    parser.add_argument('--backoff', action='store', metavar='SECONDS',
+                        type=float, default=1.0,
+                        help='Wait up to SECONDS before the first retry, and twice as long before each one after')
+    parser.add_argument('--resume', action='store_true',
+                        help="For fetch/pipeline, only fetch the pages that the last run didn't finish")
+    parser.add_argument('--enroll-url', action='store', metavar='URL',
+                        default=ENROLL_URL,
+                        help='Where to find Enroll (e.g., a local `serve`)')
+    parser.add_argument('--record', action='store', metavar='FILE',
+                        help='Save every response from Enroll into this archive')
+    parser.add_argument('--replay', action='store', metavar='FILE',
+                        help='Answer requests from this archive instead of Enroll (for serve: the archive to serve)')
+    parser.add_argument('--port', action='store', metavar='PORT',
+                        type=int, default=8000,
+                        help='For serve, the port to listen on')
+    parser.add_argument('--latency', action='store', metavar='SECONDS',
+                        type=float, default=0.0,
+                        help='For serve, roughly how long to wait before answering')
+    parser.add_argument('--error-rate', action='store', metavar='P',
+                        type=float, default=0.0,
+                        help='For serve, the fraction of requests to fail (with a 503 or a dropped connection)')
+    parser.add_argument('--poll-min', action='store', metavar='SECONDS',
+                        type=float, default=120,
+                        help='For watch, how soon to poll a subject again after its page changed')
+    parser.add_argument('--poll-max', action='store', metavar='SECONDS',
+                        type=float, default=3600,
+                        help='For watch, the longest to wait between polls of a quiet subject')
+    parser.add_argument('--rounds', action='store', metavar='N',
+                        type=int, default=0,
+                        help='For watch, stop after N rounds of polling (default: run until interrupted)')
+    parser.add_argument('--catalog-ttl', action='store', metavar='HOURS',
+                        type=float, default=12,
+                        help="How long to trust the cached list of Enroll's subjects and terms")
+    parser.add_argument('--closed-after', action='store', metavar='DAYS',
+                        type=int, default=365,
+                        help='Treat terms that ended more than DAYS days ago as closed')
+    parser.add_argument('--refetch-closed', action='store', metavar='DAYS',
+                        type=int, default=None,
+                        help='Re-fetch pages from closed terms once our copy is DAYS days old (default: never)')
+    parser.add_argument('--reverify-empty', action='store', metavar='DAYS',
+                        type=int, default=None,
+                        help='Re-fetch pages from closed terms that had no courses once our copy is DAYS days old '
+                             '(default: never, even with --refetch-closed)')
+    parser.add_argument('--force', action='store_true',
+                        help='Ignore the manifests and caches, and redo all of the work')
+    parser.add_argument('--engine', action='store',
+                        choices=ENGINES, default='bs4',
+                        help='Which HTML engine extract should use to read courses')
+    parser.add_argument('--check-parity', action='store_true',
+                        help='Instead of extracting, report any course that the engines disagree about')
+    parser.add_argument('--storage', action='store',
+                        choices=STORAGE_KINDS, default=None,
+                        help='How fetch/clean should store pages in indices/ (by default, the way they already are)')
+    parser.add_argument('--compact-html', action='store_true',
+                        help='Have fetch/clean store pages compactly, instead of prettified')
+    parser.add_argument('--compact-bundles', action='store_true',
+                        help='Write term bundles without indentation')
+    parser.add_argument('--delta-history', action='store', metavar='N',
+                        type=int, default=0,
+                        help='Keep the last N patches between versions of each bundle in <term>.delta.json (default: none)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='Also write each term as <term>.columns.json: per-field arrays over a table of strings')
+    parser.add_argument('--intervals', action='store_true',
+                        help='Also write each term as <term>.intervals.json: every meeting, sorted by minute of the week')
+    parser.add_argument('--search', action='store_true',
+                        help='Also write a search index of each term, as <term>.search.json')
+    parser.add_argument('--search-all', action='store_true',
+                        help='Like --search, plus one index of every term, as all.search.json')
+    parser.add_argument('--shards', action='store_true',
+                        help='Also split each term by subject into files named by their hash, listed in <term>.shards.json')
+    parser.add_argument('--db', action='store', metavar='FILE',
+                        help='For db/query, the SQLite database to use (default: courses.db in --dest)')
+    parser.add_argument('--sql', action='store', metavar='QUERY',
+                        help='For query, run this SQL instead of the filters below')
+    parser.add_argument('--instructor', action='store', metavar='NAME',
+                        help='For query, only show sections taught by NAME')
+    parser.add_argument('--requirement', action='store', metavar='REQ',
+                        help='For query, only show sections that satisfy REQ')
+    parser.add_argument('--tag', action='store', metavar='TAG',
+                        help='For query, only show sections tagged with TAG')
+    parser.add_argument('--day', action='store', metavar='DAY',
+                        help='For query, only show sections that meet on DAY (e.g., Mo)')
+    parser.add_argument('--at', action='store', metavar='HH:MM',
+                        help='For query, only show sections that are meeting at HH:MM (24-hour clock)')
+    parser.add_argument('--course', action='store', metavar='TEXT',
+                        help='For history, only show courses whose id contains TEXT (e.g., "CS 111")')
+    parser.add_argument('--bench-pages', action='store', metavar='N',
+                        type=int, default=20,
+                        help='For bench, how many synthetic pages to generate')
+    parser.add_argument('--bench-courses', action='store', metavar='N',
+                        type=int, default=40,
+                        help='For bench, how many courses to put on each page')
+    parser.add_argument('--bench-results', action='store', metavar='FILE',
+                        default='bench-results.jsonl',
+                        help='For bench, the file to append results to (and compare against)')
+    parser.add_argument('--metrics', action='store', metavar='FILE', dest='metrics_path',
+                        help='At the end, write a JSON report of where the time went (per stage, page and request) to FILE')
+    parser.add_argument('--profile', action='store', metavar='FILE',
+                        help='Also profile each unit of work with cProfile, and save the combined stats to FILE')
     parser.add_argument('--debug', action='store_true',
                         help='Enables debugging mode')
     parser.add_argument('--first-term', action='store', metavar='TERM',
@@ -568,45 +3346,92 @@ def main():
                         help='Fetch terms from --first-term until the given term')
     parser.add_argument('-w', '--workers', action='store', metavar='N',
                         type=int, default=0,
-                        help='How many worker processes to use (be nice to Enroll)')
+                        help='How many worker processes to use (for fetch, how many requests may be in flight)')
 
     args = parser.parse_args()
 
-    if not args.subjects:
-        args.subjects = fetch_subjects()
+    # bench works on a synthetic corpus, so it needs neither Enroll nor --dest
+    if args.command == 'bench':
+        cmd_bench(args=args)
+        return
+
+    if args.command == 'serve':
+        cmd_serve(args=args)
+        return
+
+    if args.command in ONLINE_COMMANDS and args.workers == 0:
+        args.workers = 4
+
+    root = Path(args.dest) if args.dest else Path('..') / 'course-data'
+
+    # only the commands that talk to Enroll need its catalog of subjects and
+    # terms; everything else works from what is already on disk
+    needs_catalog = args.command in ONLINE_COMMANDS or args.print_subjects or args.print_terms
+    if needs_catalog and not (args.subjects and (args.terms or args.first_term or args.last_term)):
+        catalog = load_catalog(args=args, root=root)
+    else:
+        catalog = None
+
+    if not args.subjects and catalog:
+        args.subjects = catalog['subjects']
 
     if args.print_subjects:
         [print(s) for s in args.subjects]
         return
 
+    # query searches every term in the database unless asked otherwise
+    explicit_terms = bool(args.terms or args.first_term or args.last_term)
+
     if not args.terms:
         if args.first_term or args.last_term:
             args.terms = list(discover_terms(first=args.first_term, last=args.last_term))
+        elif catalog:
+            args.terms = catalog['terms']
         else:
-            args.terms = fetch_academic_terms()
+            args.terms = terms_on_disk(root)
+
+        # watch is for registration, which is about the latest term
+        if args.command == 'watch':
+            args.terms = [max([t for t in args.terms if TERM_RE.match(t)], key=term_code)]
 
     if args.print_terms:
         [print(s) for s in args.terms]
         return
 
-    root = Path(args.dest) if args.dest else Path('..') / 'course-data'
-
-    if args.command == 'fetch':
-        if args.workers is 0:
-            args.workers = 1
-        cmd_fetch(args=args, root=root)
-    if args.command == 'clean':
-        if args.workers is 0:
-            args.workers = cpu_count()
-        cmd_clean(args=args, root=root)
-    elif args.command == 'extract':
-        if args.workers is 0:
-            args.workers = cpu_count()
-        cmd_extract(args=args, root=root)
-    elif args.command == 'bundle':
-        if args.workers is 0:
-            args.workers = cpu_count()
-        cmd_bundle(args=args, root=root)
+    args.metrics = Metrics(command=args.command, workers=args.workers or cpu_count(), profile=args.profile,
+                           enabled=bool(args.metrics_path))
+    try:
+        if args.command == 'fetch':
+            cmd_fetch(args=args, root=root)
+        if args.command == 'pipeline':
+            cmd_fetch(args=args, root=root, extract=True)
+        if args.command == 'watch':
+            cmd_watch(args=args, root=root)
+        if args.command == 'clean':
+            if args.workers is 0:
+                args.workers = cpu_count()
+            cmd_clean(args=args, root=root)
+        elif args.command == 'extract':
+            if args.workers is 0:
+                args.workers = cpu_count()
+            cmd_extract(args=args, root=root)
+        elif args.command == 'bundle':
+            if args.workers is 0:
+                args.workers = cpu_count()
+            cmd_bundle(args=args, root=root)
+        elif args.command == 'build':
+            if args.workers == 0:
+                args.workers = cpu_count()
+            cmd_build(args=args, root=root)
+        elif args.command == 'db':
+            cmd_db(args=args, root=root)
+        elif args.command == 'query':
+            cmd_query(args=args, root=root, terms=args.terms if explicit_terms else None)
+        elif args.command == 'history':
+            cmd_history(args=args, root=root)
+    finally:
+        if args.metrics_path:
+            args.metrics.save(args.metrics_path)
 
 
 if __name__ == '__main__':